@@ -0,0 +1,163 @@
+"""Benchmarks of sharding.shard_chain
+
+Run from the repository root:
+
+    python benchmark/chain_bench.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+from ethereum.config import Env
+from ethereum.utils import sha3, to_string
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sharding.config import sharding_config  # noqa: E402
+from sharding.db import SQLiteDB  # noqa: E402
+
+
+def mk_chain(shard_id, db=None, reorg_pool=None, shard_db_factory=None):
+    from sharding.tools import tester  # needs viper, unlike bench_sqlite_commits
+    c = tester.Chain(env=Env(db=db, config=sharding_config), deploy_sharding_contracts=True, reorg_pool=reorg_pool,
+                     shard_db_factory=shard_db_factory)
+    c.mine(5)
+    valcode_addr = c.sharding_valcode_addr(tester.k0)
+    c.sharding_deposit(tester.k0, valcode_addr)
+    c.mine(sharding_config['SHUFFLING_CYCLE_LENGTH'])
+    c.add_test_shard(shard_id)
+    return c
+
+
+def bench_sqlite_commits(collations=2000, writes=8):
+    """Writes shaped like `add_collation`, to a `SQLiteDB`, committed after
+    every collation and once for all of them
+    """
+    print('--- SQLiteDB, {} collations of {} writes ---'.format(collations, writes))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for batched in (False, True):
+            db = SQLiteDB(os.path.join(tmpdir, 'batched.db' if batched else 'unbatched.db'))
+            start = time.time()
+            for i in range(collations):
+                collation_hash = sha3(to_string(i))
+                db.put(collation_hash, b'\x01' * 200)
+                for prefix in (b'collation_body:', b'score:', b'skiplist:', b'changed:', b'deletes:'):
+                    db.put(prefix + collation_hash, b'\x02' * 64)
+                for j in range(writes - 6):
+                    db.put(sha3(collation_hash + to_string(j)), b'\x03' * 100)
+                if not batched:
+                    db.commit()
+            db.commit()
+            seconds = time.time() - start
+            print('{:<24} {:>10.3f} s'.format('one commit' if batched else 'commit per collation', seconds))
+            db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_import(length=200, shard_id=1):
+    """Import a run of collations one commit each and in a write batch,
+    into shards backed by their own `SQLiteDB`
+    """
+    from sharding.tools import tester  # needs viper, unlike bench_sqlite_commits
+    print('--- import {} collations ---'.format(length))
+    source = mk_chain(shard_id)
+    shard = source.chain.shards[shard_id]
+    collations = []
+    for _ in range(length):
+        collation = source.generate_collation(shard_id=shard_id, coinbase=tester.a1, key=tester.k1, txqueue=None)
+        period_start_prevblock = source.chain.get_block(collation.header.period_start_prevhash)
+        shard.add_collation(collation, period_start_prevblock)
+        shard.head_hash = collation.header.hash
+        collations.append((collation, period_start_prevblock))
+
+    tmpdir = tempfile.mkdtemp()
+    for batched in (False, True):
+        name = 'batched' if batched else 'unbatched'
+        db = SQLiteDB(os.path.join(tmpdir, name + '.db'))
+
+        def shard_db_factory(shard_id):
+            return SQLiteDB(os.path.join(tmpdir, '{}_shard_{}.db'.format(name, shard_id)))
+        target = mk_chain(shard_id, db, shard_db_factory=shard_db_factory).chain.shards[shard_id]
+        assert isinstance(target.db, SQLiteDB) and target.db is not db
+        # Count the commits of the shard db
+        commits = [0]
+        db_commit = target.db.commit
+
+        def commit():
+            commits[0] += 1
+            db_commit()
+        target.db.commit = commit
+        start = time.time()
+        if batched:
+            with target.write_batch():
+                for collation, period_start_prevblock in collations:
+                    target.add_collation(collation, period_start_prevblock)
+        else:
+            for collation, period_start_prevblock in collations:
+                target.add_collation(collation, period_start_prevblock)
+        seconds = time.time() - start
+        print('{:<24} {:>10.3f} s {:>8} commits'.format(
+            'write_batch' if batched else 'commit per collation', seconds, commits[0]))
+        target.db.close()
+        db.close()
+    shutil.rmtree(tmpdir)
+
+
+def bench_block_import(blocks=50, shard_counts=(1, 4, 16), threads=4):
+    """Mine blocks on main chains tracking different numbers of shards, to
+    show the cost of the shard head reorganization of each block, with the
+    shards reorganized in this thread and on a thread pool
+    """
+    print('--- import {} blocks ---'.format(blocks))
+    pool = ThreadPool(threads)
+    for count in shard_counts:
+        for reorg_pool in (None, pool):
+            c = mk_chain(1, reorg_pool=reorg_pool)
+            for shard_id in range(2, count + 1):
+                c.add_test_shard(shard_id)
+            start = time.time()
+            c.mine(blocks)
+            seconds = time.time() - start
+            print('{:>4} shards {:<10} {:>10.3f} s {:>10.2f} ms/block'.format(
+                count, 'no pool' if reorg_pool is None else '{} threads'.format(threads),
+                seconds, seconds * 1000 / blocks))
+    pool.close()
+
+
+def bench_block_sync(length=200, chunk_size=64):
+    """Add a run of blocks one by one and with `import_blocks`, to main
+    chains backed by `SQLiteDB`
+    """
+    from sharding.tools import tester  # needs viper, unlike bench_sqlite_commits
+    print('--- sync {} blocks ---'.format(length))
+    source = tester.Chain(env=Env(config=sharding_config))
+    source.mine(length)
+    blocks = [source.chain.get_block_by_number(i) for i in range(1, length + 1)]
+
+    tmpdir = tempfile.mkdtemp()
+    for bulk in (False, True):
+        db = SQLiteDB(os.path.join(tmpdir, 'bulk.db' if bulk else 'per_block.db'))
+        target = tester.Chain(env=Env(db=db, config=sharding_config)).chain
+        start = time.time()
+        if bulk:
+            assert target.import_blocks(blocks, chunk_size=chunk_size)[0] == length
+        else:
+            for block in blocks:
+                assert target.add_block(block)[0]
+        seconds = time.time() - start
+        print('{:<24} {:>10.3f} s {:>10.1f} blocks/s'.format(
+            'import_blocks' if bulk else 'add_block', seconds, length / seconds))
+        db.close()
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    bench_sqlite_commits()
+    bench_import()
+    bench_block_import()
+    bench_block_sync()
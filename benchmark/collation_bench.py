@@ -0,0 +1,176 @@
+"""Microbenchmarks of sharding.collation
+
+Run from the repository root:
+
+    python benchmark/collation_bench.py
+"""
+import io
+import json
+import os
+import sys
+import timeit
+
+import rlp
+from rlp.sedes import CountableList
+from ethereum import utils
+from ethereum.utils import encode_hex
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sharding.collation import (  # noqa: E402
+    CollationHeader,
+    Collation,
+    encode_headers,
+    decode_headers,
+    pack_header,
+    unpack_header,
+)
+from sharding.export import export_headers  # noqa: E402
+
+
+class LegacyCollation(rlp.Serializable):
+    """Collation with the former `__getattribute__` fallback to the header
+    """
+    fields = Collation.fields
+
+    def __init__(self, header, transactions=None):
+        self.header = header
+        self.transactions = transactions or []
+
+    def __getattribute__(self, name):
+        try:
+            return rlp.Serializable.__getattribute__(self, name)
+        except AttributeError:
+            return getattr(self.header, name)
+
+
+def report(name, seconds, number):
+    print('{:<48} {:>10.1f} ns/op'.format(name, seconds / number * 1e9))
+
+
+def bench_attribute_access(number=1000000):
+    """Attribute reads on a collation: header fields and own fields
+    """
+    print('--- attribute access ({} reads) ---'.format(number))
+    header = CollationHeader(coinbase='\x35' * 20, number=7)
+    for cls in (LegacyCollation, Collation):
+        collation = cls(header)
+        for attr in ('number', 'parent_collation_hash', 'transactions'):
+            seconds = timeit.timeit(
+                'c.{}'.format(attr),
+                globals={'c': collation},
+                number=number,
+            )
+            report('{}.{}'.format(cls.__name__, attr), seconds, number)
+
+
+def bench_batch_codec(sizes=(1000, 100000), repeat=3):
+    """Encoding and decoding lists of headers: per item, as a CountableList
+    and with the batch codec
+    """
+    header_list_sedes = CountableList(CollationHeader)
+    for size in sizes:
+        print('--- header batch codec ({} headers) ---'.format(size))
+        headers = [
+            CollationHeader(coinbase='\x35' * 20, number=i, sig=b'\x01' * 65)
+            for i in range(size)
+        ]
+        items_rlp = [rlp.encode(header) for header in headers]
+        batch_rlp = rlp.encode(headers, header_list_sedes)
+
+        def drop_cached_rlp():
+            for header in headers:
+                header.__dict__['_cached_rlp'] = None
+
+        benches = [
+            ('per-item rlp.encode', lambda: [rlp.encode(h) for h in headers], drop_cached_rlp),
+            ('rlp.encode CountableList', lambda: rlp.encode(headers, header_list_sedes), drop_cached_rlp),
+            ('encode_headers', lambda: encode_headers(headers), drop_cached_rlp),
+            # Headers keep the RLP cached by their first batch encoding
+            ('encode_headers (cached)', lambda: encode_headers(headers), None),
+            ('per-item rlp.decode', lambda: [rlp.decode(item, CollationHeader) for item in items_rlp], None),
+            ('rlp.decode CountableList', lambda: rlp.decode(batch_rlp, header_list_sedes), None),
+            ('decode_headers', lambda: decode_headers(batch_rlp), None),
+            ('decode_headers memoryview', lambda: decode_headers(memoryview(batch_rlp)), None),
+        ]
+        for name, func, setup in benches:
+            timer = timeit.Timer(func, setup=setup or 'pass')
+            seconds = min(timer.repeat(number=1, repeat=repeat))
+            report(name, seconds, size)
+
+
+def bench_packed_header(number=100000):
+    """Single header decoding: RLP against the packed format
+    """
+    print('--- header decoding ({} headers) ---'.format(number))
+    header = CollationHeader(coinbase='\x35' * 20, number=7, sig=b'\x01' * 65)
+    header_rlp = rlp.encode(header)
+    packed = pack_header(header)
+    print('{:<48} {:>10d} bytes'.format('RLP size', len(header_rlp)))
+    print('{:<48} {:>10d} bytes'.format('packed size', len(packed)))
+    for name, stmt in (
+        ('rlp.decode', 'rlp.decode(header_rlp, CollationHeader)'),
+        ('unpack_header', 'unpack_header(packed)'),
+        ('unpack_header with known hash', 'unpack_header(packed, header_hash)'),
+    ):
+        seconds = timeit.timeit(stmt, globals={
+            'rlp': rlp,
+            'CollationHeader': CollationHeader,
+            'unpack_header': unpack_header,
+            'header_rlp': header_rlp,
+            'packed': packed,
+            'header_hash': header.hash,
+        }, number=number)
+        report(name, seconds, number)
+
+
+def legacy_to_dict(header):
+    """`CollationHeader.to_dict` before the field accessors were precomputed
+    """
+    d = {}
+    for field in ('period_start_prevhash', 'parent_collation_hash',
+                  'tx_list_root', 'coinbase',
+                  'post_state_root', 'receipts_root', 'sig'):
+        d[field] = encode_hex(getattr(header, field))
+    for field in ('shard_id', 'expected_period_number', 'number'):
+        d[field] = utils.to_string(getattr(header, field))
+    assert len(d) == len(CollationHeader.fields)
+    return d
+
+
+def bench_export(size=100000):
+    """to_dict and writing headers as NDJSON, through json.dumps of a dict
+    per header and with the exporter
+    """
+    print('--- header export ({} headers) ---'.format(size))
+    headers = [
+        CollationHeader(coinbase='\x35' * 20, number=i, sig=b'\x01' * 65)
+        for i in range(size)
+    ]
+    # Leave hashing out of the comparison
+    for header in headers:
+        header.hash
+
+    def dumps_per_header():
+        f = io.StringIO()
+        for header in headers:
+            d = {k: v.decode() if isinstance(v, bytes) else v for k, v in header.to_dict().items()}
+            d['hash'] = header.hex_hash
+            f.write(json.dumps(d) + '\n')
+
+    for name, func in (
+        ('legacy to_dict', lambda: [legacy_to_dict(h) for h in headers]),
+        ('to_dict', lambda: [h.to_dict() for h in headers]),
+        ('json.dumps per header', dumps_per_header),
+        ('export_headers ndjson', lambda: export_headers(headers, io.StringIO())),
+        ('export_headers csv', lambda: export_headers(headers, io.StringIO(), fmt='csv')),
+    ):
+        seconds = min(timeit.repeat(func, number=1, repeat=3))
+        report(name, seconds, size)
+
+
+if __name__ == '__main__':
+    bench_attribute_access()
+    bench_batch_codec()
+    bench_packed_header()
+    bench_export()
@@ -1,9 +1,26 @@
 # -*- coding: utf-8 -*-
+import struct
+import weakref
+from collections import namedtuple
+from operator import attrgetter
+
 import rlp
+from rlp.codec import (
+    consume_length_prefix,
+    encode_raw,
+    length_prefix,
+)
+from rlp.exceptions import (
+    DecodingError,
+    DeserializationError,
+    SerializationError,
+)
 from rlp.sedes import (
     binary,
     CountableList,
 )
+from rlp.sedes.lists import is_sequence
+from rlp.utils import safe_ord
 from ethereum.utils import (
     hash32,
     trie_root,
@@ -18,6 +35,12 @@ from ethereum.transactions import Transaction
 from sharding.config import sharding_config
 
 
+HashCacheInfo = namedtuple(
+    'HashCacheInfo',
+    ['hash_hits', 'hash_misses', 'signing_hash_hits', 'signing_hash_misses']
+)
+
+
 class CollationHeader(rlp.Serializable):
 
     """A collation header
@@ -48,6 +71,18 @@ class CollationHeader(rlp.Serializable):
         ('sig', binary)
     ]
 
+    _field_names = frozenset(name for name, _ in fields)
+
+    # Memoized hashes, dropped whenever a field is assigned
+    _cached_hash = None
+    _cached_signing_hash = None
+
+    # Process-wide hash cache counters, see `hash_cache_info`
+    _hash_hits = 0
+    _hash_misses = 0
+    _signing_hash_hits = 0
+    _signing_hash_misses = 0
+
     def __init__(self,
                  shard_id=0,
                  expected_period_number=0,
@@ -65,16 +100,26 @@ class CollationHeader(rlp.Serializable):
         assert len(fields['coinbase']) == 20
         super(CollationHeader, self).__init__(**fields)
 
-    def __getattribute__(self, name):
-        try:
-            return rlp.Serializable.__getattribute__(self, name)
-        except AttributeError:
-            return getattr(self.header, name)
+    def __setattr__(self, name, value):
+        # `make_immutable` re-assigns every field with the same value, which
+        # must not throw the caches away
+        changed = name in self._field_names and self.__dict__.get(name, self) is not value
+        super(CollationHeader, self).__setattr__(name, value)
+        if changed:
+            # The cached RLP and hashes are stale once a field changes
+            self.__dict__['_cached_rlp'] = None
+            self.__dict__['_cached_hash'] = None
+            self.__dict__['_cached_signing_hash'] = None
 
     @property
     def hash(self):
         """The binary collation hash"""
-        return utils.sha3(rlp.encode(self))
+        if self._cached_hash is None:
+            CollationHeader._hash_misses += 1
+            self.__dict__['_cached_hash'] = utils.sha3(rlp.encode(self))
+        else:
+            CollationHeader._hash_hits += 1
+        return self._cached_hash
 
     @property
     def hex_hash(self):
@@ -82,21 +127,48 @@ class CollationHeader(rlp.Serializable):
 
     @property
     def signing_hash(self):
-        return utils.sha3(rlp.encode(self, CollationHeader.exclude(['sig'])))
+        if self._cached_signing_hash is None:
+            CollationHeader._signing_hash_misses += 1
+            self.__dict__['_cached_signing_hash'] = utils.sha3(rlp.encode(self, _unsigned_header_sedes))
+        else:
+            CollationHeader._signing_hash_hits += 1
+        return self._cached_signing_hash
 
-    def to_dict(self):
-        """Serialize the header to a readable dictionary."""
-        d = {}
+    @classmethod
+    def hash_cache_info(cls):
+        """Report the hit and miss counters of the header hash caches."""
+        return HashCacheInfo(
+            cls._hash_hits,
+            cls._hash_misses,
+            cls._signing_hash_hits,
+            cls._signing_hash_misses,
+        )
 
-        for field in ('period_start_prevhash', 'parent_collation_hash',
-                      'tx_list_root', 'coinbase',
-                      'post_state_root', 'receipts_root', 'sig'):
-            d[field] = encode_hex(getattr(self, field))
+    @classmethod
+    def reset_hash_cache_info(cls):
+        """Reset the hit and miss counters of the header hash caches."""
+        CollationHeader._hash_hits = 0
+        CollationHeader._hash_misses = 0
+        CollationHeader._signing_hash_hits = 0
+        CollationHeader._signing_hash_misses = 0
 
-        for field in ('shard_id', 'expected_period_number', 'number'):
-            d[field] = utils.to_string(getattr(self, field))
+    @classmethod
+    def deserialize(cls, serial, exclude=None, mutable=False, **kwargs):
+        """Deserialize the header, returning the interned instance if the
+        same header was decoded before, see `intern_header`
+        """
+        header = super(CollationHeader, cls).deserialize(serial, exclude=exclude, mutable=mutable, **kwargs)
+        if mutable or exclude or kwargs or cls is not CollationHeader:
+            return header
+        # `rlp.decode` only caches the RLP after this returns, so hash the
+        # serial as it is instead of serializing the header again
+        header.__dict__['_cached_rlp'] = encode_raw(serial)
+        return intern_header(header)
 
-        assert len(d) == len(CollationHeader.fields)
+    def to_dict(self):
+        """Serialize the header to a readable dictionary."""
+        d = dict(zip(_hex_field_names, map(encode_hex, _get_hex_fields(self))))
+        d.update(zip(_int_field_names, map(utils.to_string, _get_int_fields(self))))
         return d
 
     def __repr__(self):
@@ -114,6 +186,22 @@ class CollationHeader(rlp.Serializable):
         return not self.__eq__(other)
 
 
+# Built once instead of on every `signing_hash` computation
+_unsigned_header_sedes = CollationHeader.exclude(['sig'])
+
+# Field accessors of `to_dict` and the exporters in `sharding.export`
+_hex_field_names = (
+    'period_start_prevhash', 'parent_collation_hash', 'tx_list_root',
+    'coinbase', 'post_state_root', 'receipts_root', 'sig',
+)
+_int_field_names = ('shard_id', 'expected_period_number', 'number')
+assert len(_hex_field_names) + len(_int_field_names) == len(CollationHeader.fields)
+_get_hex_fields = attrgetter(*_hex_field_names)
+_get_int_fields = attrgetter(*_int_field_names)
+
+_transaction_list_sedes = CountableList(Transaction)
+
+
 class Collation(rlp.Serializable):
     """A collation.
 
@@ -126,19 +214,449 @@ class Collation(rlp.Serializable):
 
     fields = [
         ('header', CollationHeader),
-        ('transactions', CountableList(Transaction))
+        ('transactions', _transaction_list_sedes)
     ]
 
+    _transactions = None
+    # The serialized transaction list -- either its RLP or the list decoded
+    # by `rlp.decode` -- kept until `transactions` is first read
+    _transactions_serial = None
+
     def __init__(self, header, transactions=None):
         self.header = header
         self.transactions = transactions or []
 
-    def __getattribute__(self, name):
-        try:
-            return rlp.Serializable.__getattribute__(self, name)
-        except AttributeError:
-            return getattr(self.header, name)
+    @property
+    def transactions(self):
+        if self._transactions_serial is not None:
+            serial = self._transactions_serial
+            if not is_sequence(serial):
+                serial = rlp.decode(serial)
+            self.__dict__['_transactions'] = _transaction_list_sedes.deserialize(serial)
+            self.__dict__['_transactions_serial'] = None
+        return self._transactions
+
+    @transactions.setter
+    def transactions(self, value):
+        self.__dict__['_transactions'] = value
+        self.__dict__['_transactions_serial'] = None
+
+    @classmethod
+    def deserialize(cls, serial, exclude=None, mutable=False, **kwargs):
+        """Deserialize the header and defer the transactions until they are
+        first read
+        """
+        if exclude or kwargs or not (is_sequence(serial) and len(serial) == 2 and is_sequence(serial[1])):
+            return super(Collation, cls).deserialize(serial, exclude=exclude, mutable=mutable, **kwargs)
+        header = CollationHeader.deserialize(serial[0], mutable=mutable)
+        collation = cls.from_serialized_transactions(header, serial[1], mutable)
+        if mutable:
+            return collation
+        # Compared by `intern_collation` with the RLP of an interned
+        # collation, see `CollationHeader.deserialize`
+        collation._cached_rlp = encode_raw(serial)
+        return intern_collation(collation)
+
+    @classmethod
+    def lazy_decode(cls, collation_rlp):
+        """Decode an RLP encoded collation, keeping the RLP of its transaction
+        list undecoded until `transactions` is first read
+        """
+        list_type, length, start = consume_length_prefix(collation_rlp, 0)
+        if list_type is not list or start + length != len(collation_rlp):
+            raise DecodingError('Collation RLP is not a single list', collation_rlp)
+        _, header_length, header_start = consume_length_prefix(collation_rlp, start)
+        header_end = header_start + header_length
+        header = decode_header(collation_rlp[start:header_end])
+
+        transactions_rlp = collation_rlp[header_end:]
+        list_type, length, start = consume_length_prefix(transactions_rlp, 0)
+        if list_type is not list or start + length != len(transactions_rlp):
+            raise DecodingError('Transaction list RLP is not a single list', collation_rlp)
+
+        collation = cls.from_serialized_transactions(header, transactions_rlp)
+        collation._cached_rlp = collation_rlp
+        return intern_collation(collation)
+
+    @classmethod
+    def from_serialized_transactions(cls, header, transactions_serial, mutable=False):
+        """Make a collation from a header and a serialized transaction list,
+        either RLP or as decoded by `rlp.decode`, which is deserialized when
+        `transactions` is first read
+        """
+        collation = cls(header)
+        collation.__dict__['_transactions'] = None
+        collation.__dict__['_transactions_serial'] = transactions_serial
+        if mutable:
+            return rlp.make_mutable(collation)
+        collation._mutable = False
+        return collation
+
+    def __getattr__(self, name):
+        # Only called when the normal lookup fails, i.e. for header
+        # attributes that are not generated below
+        if name == 'header' or name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.header, name)
+
+    @property
+    def transactions_rlp(self):
+        """The RLP of the transaction list, without deserializing it if it has
+        not been read yet
+        """
+        serial = self._transactions_serial
+        if serial is None:
+            return rlp.encode(self.transactions, _transaction_list_sedes)
+        if is_sequence(serial):
+            return rlp.encode(serial)
+        return serial
 
     @property
     def transaction_count(self):
-        return len(self.transactions)
+        if self._transactions_serial is None:
+            return len(self.transactions)
+        # Count without deserializing the transactions
+        serial = self._transactions_serial
+        if is_sequence(serial):
+            return len(serial)
+        _, length, position = consume_length_prefix(serial, 0)
+        end = position + length
+        count = 0
+        while position < end:
+            _, length, position = consume_length_prefix(serial, position)
+            position += length
+            count += 1
+        return count
+
+
+def _delegate_to_header(cls, names):
+    """Generate read-only properties on `cls` that forward `names` to
+    `self.header`, so that e.g. `collation.number` is resolved without a
+    Python-level `__getattr__` call
+    """
+    for name in names:
+        setattr(cls, name, property(
+            attrgetter('header.' + name),
+            doc='Alias of `header.{}`'.format(name),
+        ))
+
+
+_delegate_to_header(
+    Collation,
+    [name for name, _ in CollationHeader.fields] + ['hash', 'hex_hash', 'signing_hash', 'to_dict'],
+)
+
+
+# Process-wide tables of the decoded, immutable headers and collations that
+# are alive, keyed by hash, so that decoding the same object again (e.g. when
+# it is received from several peers or read from the db repeatedly) returns
+# the instance already in memory along with its cached RLP and hashes
+_interned_headers = weakref.WeakValueDictionary()
+_interned_collations = weakref.WeakValueDictionary()
+
+
+def intern_header(header):
+    """Return the interned instance of an immutable header with the same
+    hash, interning `header` if there is none. Mutable headers are returned
+    as they are.
+    """
+    if header.is_mutable():
+        return header
+    collation_hash = header.hash
+    interned = _interned_headers.get(collation_hash)
+    if interned is not None and not interned.is_mutable():
+        return interned
+    _interned_headers[collation_hash] = header
+    return header
+
+
+def intern_collation(collation):
+    """Return the interned instance of an immutable collation with the same
+    hash and the same transactions, interning `collation`, with its header
+    interned, if there is none. Mutable collations are returned as they are.
+    """
+    if collation.is_mutable():
+        return collation
+    collation_hash = collation.header.hash
+    interned = _interned_collations.get(collation_hash)
+    if interned is not None and not interned.is_mutable():
+        # The transactions are not covered by the hash, so compare them too
+        if interned._cached_rlp is not None and collation._cached_rlp is not None:
+            same = interned._cached_rlp == collation._cached_rlp
+        else:
+            same = interned.transactions_rlp == collation.transactions_rlp
+        if same:
+            return interned
+        return collation
+    collation.__dict__['header'] = intern_header(collation.header)
+    _interned_collations[collation_hash] = collation
+    return collation
+
+
+def is_legacy_collation_rlp(collation_rlp):
+    """Check if an RLP encoded value stored under a collation hash is a whole
+    collation, as written before headers and bodies were stored separately,
+    rather than a collation header
+
+    The first item of a collation is its header, which is a list, while the
+    first item of a header is its shard id.
+    """
+    _, _, start = consume_length_prefix(collation_rlp, 0)
+    return start < len(collation_rlp) and safe_ord(collation_rlp[start]) >= 0xc0
+
+
+_header_fields = tuple(CollationHeader.fields)
+
+
+def _list_rlp(items_rlp):
+    payload = b''.join(items_rlp)
+    return length_prefix(len(payload), 0xc0) + payload
+
+
+def _string_rlp(value):
+    if len(value) == 1 and value < b'\x80':
+        return value
+    return length_prefix(len(value), 0x80) + value
+
+
+def _encode_header(header):
+    """RLP encode a header, the same as `rlp.encode(header)`, without the
+    generic serialization of nested lists
+    """
+    return _list_rlp([
+        _string_rlp(sedes.serialize(getattr(header, name)))
+        for name, sedes in _header_fields
+    ])
+
+
+def _consume_list(data, start, what):
+    """Read the prefix of the list at `start`, returning the positions of its
+    payload
+    """
+    list_type, length, position = consume_length_prefix(data, start)
+    end = position + length
+    if list_type is not list or end > len(data):
+        raise DecodingError('{} RLP is not a list'.format(what), data)
+    return position, end
+
+
+def _decode_header_at(data, start):
+    """Decode the header whose RLP starts at `start`, without going through
+    `CollationHeader.__init__`, returning it and the position after it
+    """
+    position, end = _consume_list(data, start, 'Collation header')
+    values = {}
+    for name, sedes in _header_fields:
+        if position >= end:
+            raise DecodingError('Collation header RLP has too few fields', data)
+        item_type, length, position = consume_length_prefix(data, position)
+        if item_type is not str:
+            raise DecodingError('Collation header field {} is a list'.format(name), data)
+        values[name] = sedes.deserialize(bytes(data[position:position + length]))
+        position += length
+    if position != end:
+        raise DecodingError('Collation header RLP has too many fields', data)
+
+    header = CollationHeader.__new__(CollationHeader)
+    header.__dict__.update(values)
+    header.__dict__['_cached_rlp'] = bytes(data[start:end])
+    header.__dict__['_mutable'] = False
+    return intern_header(header), end
+
+
+def _decode_collation_at(data, start):
+    """Decode the collation whose RLP starts at `start`, keeping its
+    transaction list as RLP, returning it and the position after it
+    """
+    position, end = _consume_list(data, start, 'Collation')
+    header, position = _decode_header_at(data, position)
+    transactions_start = position
+    _, position = _consume_list(data, position, 'Transaction list')
+    if position != end:
+        raise DecodingError('Collation RLP has too many fields', data)
+
+    collation = Collation.__new__(Collation)
+    collation.__dict__.update({
+        'header': header,
+        '_transactions': None,
+        '_transactions_serial': bytes(data[transactions_start:end]),
+        '_cached_rlp': bytes(data[start:end]),
+        '_mutable': False,
+    })
+    return intern_collation(collation), end
+
+
+def _decode_list(data, decode_item):
+    position, end = _consume_list(data, 0, 'Batch')
+    if end != len(data):
+        raise DecodingError('Batch RLP ends with {} superfluous bytes'.format(len(data) - end), data)
+    items = []
+    while position < end:
+        item, position = decode_item(data, position)
+        items.append(item)
+    return items
+
+
+def encode_headers(headers):
+    """RLP encode a sequence of collation headers as a single list, the same
+    as `rlp.encode(headers, CountableList(CollationHeader))`
+
+    The RLP of every header is cached on it, since headers drop it as soon
+    as one of their fields changes.
+    """
+    items_rlp = []
+    for header in headers:
+        header_rlp = header._cached_rlp
+        if header_rlp is None:
+            header_rlp = _encode_header(header)
+            header.__dict__['_cached_rlp'] = header_rlp
+        items_rlp.append(header_rlp)
+    return _list_rlp(items_rlp)
+
+
+def decode_header(data):
+    """Decode an RLP encoded collation header, hashing the given RLP instead
+    of encoding the header again
+
+    :returns: an immutable header, as `rlp.decode(data, CollationHeader)`
+              would return it
+    """
+    header, end = _decode_header_at(data, 0)
+    if end != len(data):
+        raise DecodingError('Collation header RLP ends with {} superfluous bytes'.format(len(data) - end), data)
+    return header
+
+
+def decode_headers(data):
+    """Decode a list of collation headers encoded by `encode_headers`
+
+    :param data: `bytes`, `bytearray` or a `memoryview` of them, which is
+                 read in place
+    :returns: a list of immutable headers, as `rlp.decode` would return them
+    """
+    return _decode_list(data, _decode_header_at)
+
+
+def encode_collations(collations):
+    """RLP encode a sequence of collations as a single list, the same as
+    `rlp.encode(collations, CountableList(Collation))`, without deserializing
+    the transactions of collations that were decoded lazily
+    """
+    items_rlp = []
+    for collation in collations:
+        collation_rlp = collation._cached_rlp
+        if collation_rlp is None:
+            collation_rlp = _list_rlp([
+                collation.header._cached_rlp or _encode_header(collation.header),
+                collation.transactions_rlp,
+            ])
+        items_rlp.append(collation_rlp)
+    return _list_rlp(items_rlp)
+
+
+def decode_collations(data):
+    """Decode a list of collations encoded by `encode_collations`
+
+    The transactions of each collation are deserialized when first read, see
+    `Collation.lazy_decode`.
+
+    :param data: `bytes`, `bytearray` or a `memoryview` of them, which is
+                 read in place
+    :returns: a list of immutable collations
+    """
+    return _decode_list(data, _decode_collation_at)
+
+
+# Packed header format: a version byte, shard_id, expected_period_number and
+# number as unsigned 64-bit integers, the five 32-byte hashes, the coinbase
+# and the length of `sig`, followed by `sig` itself. Canonical RLP remains the
+# format for hashing and for the validator manager contract.
+PACKED_HEADER_VERSION = 1
+
+_packed_header_struct = struct.Struct('>BQQQ32s32s32s32s32s20sH')
+_packed_header_fields = (
+    'shard_id', 'expected_period_number', 'number',
+    'period_start_prevhash', 'parent_collation_hash', 'tx_list_root',
+    'post_state_root', 'receipts_root', 'coinbase',
+)
+_packed_binary_fields = [
+    (name, dict(CollationHeader.fields)[name]) for name in _packed_header_fields[3:]
+]
+_max_packed_int = 2**64 - 1
+_max_packed_sig_length = 2**16 - 1
+
+
+def pack_header(header):
+    """Pack a collation header into the fixed-layout binary format
+
+    :raises: :exc:`ValueError` if a field does not fit the format, or
+             :exc:`rlp.SerializationError` if it is invalid
+    """
+    values = [getattr(header, name) for name in _packed_header_fields[:3]]
+    for name, value in zip(_packed_header_fields, values):
+        if not 0 <= value <= _max_packed_int:
+            raise ValueError('{} does not fit in 64 bits: {}'.format(name, value))
+    # The field sedes check the lengths of the hashes, which `struct` would
+    # pad silently, and turn fields that were set as str into bytes
+    values += [sedes.serialize(getattr(header, name)) for name, sedes in _packed_binary_fields]
+    if len(values[-1]) != 20:
+        raise ValueError('Invalid coinbase length: {}'.format(len(values[-1])))
+    sig = binary.serialize(header.sig)
+    if len(sig) > _max_packed_sig_length:
+        raise ValueError('Signature too long: {}'.format(len(sig)))
+    return _packed_header_struct.pack(PACKED_HEADER_VERSION, *(values + [len(sig)])) + sig
+
+
+def unpack_header(data, header_hash=None):
+    """Unpack a collation header packed by `pack_header`
+
+    :param data: `bytes`, `bytearray` or a `memoryview` of them
+    :param header_hash: the hash of the header if already known, e.g. from
+                        the key it was stored under, so that it is not
+                        recomputed
+    :returns: an immutable header
+    """
+    if len(data) < _packed_header_struct.size:
+        raise ValueError('Packed header too short: {}'.format(len(data)))
+    values = _packed_header_struct.unpack_from(data)
+    if values[0] != PACKED_HEADER_VERSION:
+        raise ValueError('Unknown packed header version: {}'.format(values[0]))
+    sig_length = values[-1]
+    if len(data) != _packed_header_struct.size + sig_length:
+        raise ValueError('Packed header has wrong length: {}'.format(len(data)))
+
+    header = CollationHeader.__new__(CollationHeader)
+    header.__dict__.update(zip(_packed_header_fields, values[1:-1]))
+    header.__dict__['sig'] = bytes(data[_packed_header_struct.size:])
+    header.__dict__['_mutable'] = False
+    if header_hash is None:
+        return header
+    header.__dict__['_cached_hash'] = header_hash
+    return intern_header(header)
+
+
+def is_packed_header(data):
+    """Check if stored header data is in the packed format rather than RLP,
+    whose first byte is a list prefix
+    """
+    return safe_ord(data[0]) == PACKED_HEADER_VERSION
+
+
+class PackedCollationHeader(object):
+    """A sedes for collation headers in the packed format, for messages
+    """
+
+    def serialize(self, obj):
+        try:
+            return pack_header(obj)
+        except (AttributeError, TypeError, ValueError, SerializationError) as e:
+            raise SerializationError(str(e), obj)
+
+    def deserialize(self, serial):
+        try:
+            return unpack_header(serial)
+        except (TypeError, ValueError) as e:
+            raise DeserializationError(str(e), serial)
+
+
+packed_header = PackedCollationHeader()
@@ -1,5 +1,6 @@
 import rlp
 
+from ethereum import utils
 from ethereum.slogging import get_logger
 from ethereum.consensus_strategy import get_consensus_strategy
 from ethereum.common import mk_block_from_prevstate
@@ -8,7 +9,10 @@ from ethereum.exceptions import VerificationFailed
 
 from sharding import state_transition
 from sharding.contract_utils import sign
-from sharding.validator_manager_utils import call_valmgr
+from sharding.validator_manager_utils import (
+    call_valmgr,
+    get_valcode_signer,
+)
 from sharding.receipt_consuming_tx_utils import apply_shard_transaction
 
 log = get_logger('sharding.collator')
@@ -92,7 +96,7 @@ def create_collation(
     collation.header.parent_collation_hash = parent_collation_hash
     collation.header.expected_period_number = expected_period_number
     collation.header.period_start_prevhash = period_start_prevhash
-    collation.header.number = chain.shards[shard_id].get_collation(parent_collation_hash).number + 1
+    collation.header.number = chain.shards[shard_id].get_collation_header(parent_collation_hash).number + 1
 
     try:
         sig = sign(collation.signing_hash, key)
@@ -105,22 +109,65 @@ def create_collation(
     return collation
 
 
-def verify_collation_header(chain, header):
+def get_collator_signer(state, shard_id):
+    """Get the address that the collator sampled for a shard signs with, as
+    `add_header` checks it in `state`, or None if it cannot be resolved
+    locally, e.g. if the sampled validation code is not the code of
+    `mk_validation_code`
+    """
+    try:
+        valcode_addr = utils.zpad(utils.int_to_big_endian(int(call_valmgr(state, 'sample', [shard_id]), 16)), 20)
+    except Exception:
+        return None
+    if valcode_addr == b'\x00' * 20:
+        return None
+    return get_valcode_signer(state, valcode_addr)
+
+
+def get_collator_sig(header):
+    """Get the signature of a header as the validation code reads it from
+    its call data, i.e. the first 96 bytes, zero padded
+    """
+    return utils.to_string(header.sig)[:96].ljust(96, b'\x00')
+
+
+def mk_add_header_state(chain):
+    """Make the state in which a header received now would be added, i.e.
+    the main chain head state initialized for the next block
+    """
+    state = chain.state.ephemeral_clone()
+    block = mk_block_from_prevstate(chain, timestamp=chain.state.timestamp + 14)
+    cs = get_consensus_strategy(state.config)
+    cs.initialize(state, block)
+    return state
+
+
+def verify_collation_header(chain, header, sig_verifier=None):
     """Verify the collation
 
     Validate the collation header before calling ShardChain.add_collation
 
     chain: MainChain
     header: the given collation header
+    sig_verifier: optional SignatureVerifier. With it, the signature is
+        checked locally against the address of the collator sampled for the
+        shard, as `add_header` checks it, before calling the contract; if
+        that address cannot be resolved, the contract alone decides. The
+        headers that pass are remembered for the current main chain head,
+        and verified again without calling the contract.
     """
     if header.shard_id < 0:
         raise ValueError('Invalid shard_id %d' % header.shard_id)
 
+    if sig_verifier is not None and sig_verifier.is_header_verified(header.hash, chain.head_hash):
+        return True
+
     # Call contract to verify header
-    state = chain.state.ephemeral_clone()
-    block = mk_block_from_prevstate(chain, timestamp=chain.state.timestamp + 14)
-    cs = get_consensus_strategy(state.config)
-    cs.initialize(state, block)
+    state = mk_add_header_state(chain)
+    if sig_verifier is not None:
+        signer = get_collator_signer(state, header.shard_id)
+        if signer is not None and not sig_verifier.verify(header.signing_hash, get_collator_sig(header), signer):
+            raise ValueError('Invalid collation signature')
     # Collation Gas Limit
     gas_limit = call_valmgr(chain.state, 'get_collation_gas_limit', [])
     state_transition.set_collation_gas_limit(state, gas_limit)
@@ -134,6 +181,8 @@ def verify_collation_header(chain, header):
             raise ValueError('Calling add_header returns False')
     except Exception as e:
         raise ValueError('Failed to call add_header', str(e))
+    if sig_verifier is not None:
+        sig_verifier.add_verified_header(header.hash, chain.head_hash)
     return True
 
 
@@ -146,6 +195,15 @@ def get_deep_collation_hash(chain, shard_id, depth):
     """
     collhash = call_valmgr(chain.state, 'get_shard_head', [shard_id])
 
+    # Use the ancestor index if the head collation is stored locally. The
+    # walk below stops at the first collation, not at the genesis.
+    if chain.has_shard(shard_id):
+        header = chain.shards[shard_id].get_collation_header(collhash)
+        if header is not None and header.number > 0:
+            ancestor = chain.shards[shard_id].get_ancestor_hash(collhash, min(depth, header.number - 1))
+            if ancestor is not None:
+                return ancestor
+
     for _ in range(depth):
         temp_collhash = call_valmgr(
             chain.state,
@@ -0,0 +1,209 @@
+import os
+import re
+import sqlite3
+
+from ethereum.db import BaseDB, EphemDB
+from ethereum.slogging import get_logger
+from ethereum.utils import to_string
+
+log = get_logger('sharding.db')
+
+# Namespaces of the keys written by the main and shard chains. Keys are
+# stored by namespace, so that a namespace can be scanned, measured or
+# dropped with an index range instead of a full scan.
+KEY_PREFIXES = (
+    b'score:',
+    b'changed:',
+    b'deletes:',
+    b'block:',
+    b'txindex:',
+    b'collation_body:',
+    b'skiplist:',
+    b'state:',
+    b'address:',
+    b'coll_blocks:',
+    b'head_coll:',
+)
+_shard_prefix_re = re.compile(b'^SHARD_[0-9]+_|^shard_[0-9]+_')
+
+
+def split_key(key):
+    """Split a key into its namespace, one of `KEY_PREFIXES` or a
+    `SHARD_<id>_` prefix, and the rest, with an empty namespace for other
+    keys such as trie nodes
+    """
+    for prefix in KEY_PREFIXES:
+        if key.startswith(prefix):
+            return prefix, key[len(prefix):]
+    match = _shard_prefix_re.match(key)
+    if match:
+        return match.group(), key[match.end():]
+    return b'', key
+
+
+def db_size(db):
+    """Get the total size of the keys and values of a `SQLiteDB` or an
+    `EphemDB`
+    """
+    if isinstance(db, SQLiteDB):
+        return db.size()
+    return sum(len(key) + len(value) for key, value in db.kv.items())
+
+
+def drop_db(db):
+    """Drop the data of a db that is no longer used, deleting the files of
+    a `SQLiteDB`
+    """
+    if isinstance(db, SQLiteDB):
+        db.destroy()
+    elif isinstance(db, EphemDB):
+        db.db.clear()
+
+
+def _prefix_range(prefix):
+    """The namespace and the bounds of the rest of the keys with a prefix
+    """
+    namespace, rest = split_key(prefix)
+    stop = bytearray(rest.rstrip(b'\xff'))
+    if not stop:
+        return namespace, rest, None
+    stop[-1] += 1
+    return namespace, rest, bytes(stop)
+
+
+class SQLiteDB(BaseDB):
+    """A persistent db in a single SQLite file, needing no server
+
+    Writes are buffered in memory until `commit`, which writes them in one
+    transaction. Reads go through SQLite's memory-mapped I/O and a page
+    cache of bounded size, so the memory used doesn't grow with the db.
+
+    :param path: the database file, created if missing
+    :param mmap_size: the number of bytes of the file to memory-map
+    :param cache_kib: the size of SQLite's page cache in KiB
+    """
+
+    def __init__(self, path, mmap_size=1 << 30, cache_kib=64 * 1024):
+        self.path = path
+        # Readable from the worker threads of `MainChain.reorg_pool`
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA mmap_size={:d}'.format(mmap_size))
+        self.conn.execute('PRAGMA cache_size={:d}'.format(-cache_kib))
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS kv ('
+            'ns BLOB NOT NULL, key BLOB NOT NULL, value BLOB NOT NULL, '
+            'PRIMARY KEY (ns, key)) WITHOUT ROWID'
+        )
+        self.conn.commit()
+        # key -> value, or None for deletes
+        self.uncommitted = {}
+
+    def get(self, key):
+        if key in self.uncommitted:
+            value = self.uncommitted[key]
+            if value is None:
+                raise KeyError(key)
+            return value
+        row = self.conn.execute('SELECT value FROM kv WHERE ns = ? AND key = ?', split_key(key)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return bytes(row[0])
+
+    def put(self, key, value):
+        # pyethereum stores some values, e.g. block scores, as str
+        self.uncommitted[key] = to_string(value)
+
+    def delete(self, key):
+        self.uncommitted[key] = None
+
+    def commit(self):
+        if not self.uncommitted:
+            return
+        puts = []
+        deletes = []
+        for key, value in self.uncommitted.items():
+            ns, rest = split_key(key)
+            if value is None:
+                deletes.append((ns, rest))
+            else:
+                puts.append((ns, rest, value))
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO kv VALUES (?, ?, ?)', puts)
+            self.conn.executemany('DELETE FROM kv WHERE ns = ? AND key = ?', deletes)
+        log.debug('Committed %d puts and %d deletes' % (len(puts), len(deletes)))
+        self.uncommitted = {}
+
+    def _has_key(self, key):
+        try:
+            self.get(key)
+            return True
+        except KeyError:
+            return False
+
+    def __contains__(self, key):
+        return self._has_key(key)
+
+    def _where_prefix(self, prefix):
+        namespace, start, stop = _prefix_range(prefix)
+        if stop is None:
+            return 'ns = ? AND key >= ?', (namespace, start)
+        return 'ns = ? AND key >= ? AND key < ?', (namespace, start, stop)
+
+    def iter_prefix(self, prefix):
+        """Iterate over the committed `(key, value)` pairs whose key starts
+        with `prefix`, in key order
+
+        The prefix has to start with a whole namespace, e.g. `b'score:'` or
+        `b'SHARD_1_'`, unless it is a prefix of keys without one.
+        """
+        namespace = split_key(prefix)[0]
+        where, params = self._where_prefix(prefix)
+        cursor = self.conn.execute('SELECT key, value FROM kv WHERE ' + where + ' ORDER BY key', params)
+        for rest, value in cursor:
+            yield namespace + bytes(rest), bytes(value)
+
+    def prefix_size(self, prefix):
+        """Get the number of committed keys starting with `prefix` and the
+        total size of their keys and values
+        """
+        where, params = self._where_prefix(prefix)
+        count, size = self.conn.execute(
+            'SELECT COUNT(*), TOTAL(LENGTH(ns) + LENGTH(key) + LENGTH(value)) FROM kv WHERE ' + where,
+            params,
+        ).fetchone()
+        return count, int(size)
+
+    def delete_prefix(self, prefix):
+        """Delete the keys starting with `prefix` right away, after
+        committing the buffered writes, returning the number of keys deleted
+        """
+        self.commit()
+        where, params = self._where_prefix(prefix)
+        with self.conn:
+            return self.conn.execute('DELETE FROM kv WHERE ' + where, params).rowcount
+
+    def size(self):
+        """Get the total size of the committed keys and values
+        """
+        return int(self.conn.execute('SELECT TOTAL(LENGTH(ns) + LENGTH(key) + LENGTH(value)) FROM kv').fetchone()[0])
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def destroy(self):
+        """Close the db without committing and delete its files
+        """
+        self.uncommitted = {}
+        self.conn.close()
+        for path in (self.path, self.path + '-wal', self.path + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self.path == other.path
+
+    def __hash__(self):
+        return hash(self.path)
@@ -0,0 +1,84 @@
+from ethereum.utils import encode_hex
+
+from sharding.collation import (
+    CollationHeader,
+    _hex_field_names,
+    _int_field_names,
+    _get_hex_fields,
+    _get_int_fields,
+)
+
+
+HEADER_COLUMNS = ['hash'] + [name for name, _ in CollationHeader.fields]
+COLLATION_COLUMNS = HEADER_COLUMNS + ['transaction_count']
+
+# Values are written as strings like in `CollationHeader.to_dict`, hashes and
+# binary fields in hex, integers in decimal since they may exceed the range
+# JSON readers handle exactly. Neither needs escaping in JSON or CSV.
+_value_names = ['hash'] + list(_hex_field_names) + list(_int_field_names) + ['transaction_count']
+
+
+def _header_values(header):
+    values = [encode_hex(header.hash)]
+    values.extend(map(encode_hex, _get_hex_fields(header)))
+    values.extend(map(str, _get_int_fields(header)))
+    return values
+
+
+def _collation_values(collation):
+    values = _header_values(collation.header)
+    values.append(str(collation.transaction_count))
+    return values
+
+
+def _line_template(columns, fmt):
+    """A `str.format` template picking the columns out of the values, which
+    come in the order of `_value_names`
+    """
+    fields = ['{{{}}}'.format(_value_names.index(column)) for column in columns]
+    if fmt == 'ndjson':
+        pairs = ['"{}": "{}"'.format(column, field) for column, field in zip(columns, fields)]
+        return '{{' + ', '.join(pairs) + '}}\n'
+    elif fmt == 'csv':
+        return ','.join(fields) + '\n'
+    else:
+        raise ValueError('Unknown export format: {}'.format(fmt))
+
+
+def _export(items, fileobj, get_values, columns, fmt, chunk_size):
+    format_line = _line_template(columns, fmt).format
+    if fmt == 'csv':
+        fileobj.write(','.join(columns) + '\n')
+    count = 0
+    lines = []
+    for item in items:
+        lines.append(format_line(*get_values(item)))
+        if len(lines) == chunk_size:
+            fileobj.write(''.join(lines))
+            count += len(lines)
+            lines = []
+    fileobj.write(''.join(lines))
+    return count + len(lines)
+
+
+def export_headers(headers, fileobj, fmt='ndjson', chunk_size=1024):
+    """Write collation headers to a text file object, one line each, as
+    newline-delimited JSON objects or as CSV rows after a row of column names,
+    with the columns of `HEADER_COLUMNS`
+
+    :param headers: any iterable of headers, consumed lazily
+    :param fmt: `'ndjson'` or `'csv'`
+    :param chunk_size: the number of lines given to each `fileobj.write`
+    :returns: the number of headers written
+    """
+    return _export(headers, fileobj, _header_values, HEADER_COLUMNS, fmt, chunk_size)
+
+
+def export_collations(collations, fileobj, fmt='ndjson', chunk_size=1024):
+    """Write collations like `export_headers`, with the columns of
+    `COLLATION_COLUMNS`, i.e. the header and the number of transactions
+
+    The transactions of lazily decoded collations are counted without
+    deserializing them.
+    """
+    return _export(collations, fileobj, _collation_values, COLLATION_COLUMNS, fmt, chunk_size)
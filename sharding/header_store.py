@@ -0,0 +1,101 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class HeaderStore(object):
+    """A columnar store of the collation headers of a shard
+
+    Every header gets a row, in the order in which they are added, in
+    parallel arrays of numbers, periods, scores, hashes and parent rows, so
+    that history scans are vectorized instead of going through
+    `CollationHeader` objects. The parent row is -1 when the parent is not in
+    the store, e.g. for the first collation.
+    """
+
+    def __init__(self, capacity=1024):
+        if np is None:
+            raise ImportError('HeaderStore requires numpy')
+        self.size = 0
+        self.row_of_hash = {}
+        self.numbers = np.zeros(capacity, dtype=np.int64)
+        self.periods = np.zeros(capacity, dtype=np.int64)
+        self.scores = np.zeros(capacity, dtype=np.int64)
+        self.parents = np.zeros(capacity, dtype=np.int64)
+        # 'S32' would drop the trailing zero bytes of a hash
+        self.hashes = np.zeros(capacity, dtype='V32')
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, collation_hash):
+        return collation_hash in self.row_of_hash
+
+    def _grow(self):
+        capacity = 2 * len(self.numbers)
+        for name in ('numbers', 'periods', 'scores', 'parents', 'hashes'):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def add(self, header, score):
+        """Add a header with its score, returning its row
+        """
+        collation_hash = header.hash
+        if collation_hash in self.row_of_hash:
+            return self.row_of_hash[collation_hash]
+        if self.size == len(self.numbers):
+            self._grow()
+
+        row = self.size
+        self.numbers[row] = header.number
+        self.periods[row] = header.expected_period_number
+        self.scores[row] = score
+        self.parents[row] = self.row_of_hash.get(header.parent_collation_hash, -1)
+        self.hashes[row] = collation_hash
+        self.row_of_hash[collation_hash] = row
+        self.size += 1
+        return row
+
+    def column(self, name):
+        """A read-only view of the filled part of a column
+        """
+        view = getattr(self, name)[:self.size]
+        view.flags.writeable = False
+        return view
+
+    def get_hashes(self, rows):
+        """Get the collation hashes of the given rows
+        """
+        return [h.tobytes() for h in self.hashes[rows]]
+
+    def rows_in_period_range(self, start, stop):
+        """Get the rows of the collations with `start <= period < stop`
+        """
+        periods = self.periods[:self.size]
+        return np.flatnonzero((periods >= start) & (periods < stop))
+
+    def max_score_per_period(self):
+        """Get the periods that have collations, in ascending order, and the
+        highest collation score of each
+        """
+        if self.size == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        periods = self.periods[:self.size]
+        order = np.argsort(periods, kind='mergesort')
+        sorted_periods = periods[order]
+        starts = np.flatnonzero(np.r_[True, sorted_periods[1:] != sorted_periods[:-1]])
+        return sorted_periods[starts], np.maximum.reduceat(self.scores[:self.size][order], starts)
+
+    def best_row(self, rows=None):
+        """Get the row with the highest score among `rows`, or all rows, the
+        earliest added on ties, or -1 if there is none
+        """
+        scores = self.scores[:self.size]
+        if rows is None:
+            return int(np.argmax(scores)) if self.size else -1
+        if len(rows) == 0:
+            return -1
+        return int(rows[np.argmax(scores[rows])])
@@ -1,27 +1,28 @@
 from builtins import super
 import itertools
+from collections import deque
+from contextlib import contextmanager
 
 import rlp
-from rlp.sedes import List, binary
 
 from ethereum.slogging import get_logger
 from ethereum.pow.chain import Chain
-from ethereum.utils import (
-    sha3,
-    hash32,
-    big_endian_to_int,
-    encode_hex,
-)
+from ethereum.utils import encode_hex
 from ethereum import utils
 from ethereum.meta import apply_block
 from ethereum.exceptions import (
     InvalidTransaction,
     VerificationFailed,
 )
-from ethereum.db import RefcountDB
+from ethereum.config import Env
+from ethereum.db import EphemDB, RefcountDB
 
+from sharding.db import drop_db
 from sharding.shard_chain import ShardChain
-from sharding.validator_manager_utils import ADD_HEADER_TOPIC
+from sharding.validator_manager_utils import (
+    add_header_topic,
+    decode_add_header_logs,
+)
 
 log = get_logger('eth.chain')
 
@@ -31,13 +32,71 @@ class MainChain(Chain):
     """
 
     def __init__(self, genesis=None, env=None,
-                 new_head_cb=None, reset_genesis=False, localtime=None, **kwargs):
+                 new_head_cb=None, reset_genesis=False, localtime=None, shard_db_factory=None,
+                 reorg_pool=None, **kwargs):
         super().__init__(
             genesis=genesis, env=env,
             new_head_cb=new_head_cb, reset_genesis=reset_genesis, localtime=localtime, **kwargs)
+        # shard_id -> a new db for a shard, called for every shard chain
+        # built, see `mk_shard_env`
+        self.shard_db_factory = shard_db_factory
+        # A `multiprocessing.pool.ThreadPool` to decide the heads of the
+        # shards with, see `reorganize_shards`
+        self.reorg_pool = reorg_pool
         self.shards = {}
         self.shard_id_list = set()
         self.add_header_logs = []
+        # Counters of the add_header logs seen and of those of the watched
+        # shards, see `parse_add_header_logs`
+        self.add_header_logs_seen = 0
+        self.add_header_logs_watched = 0
+        # Nesting depth of `write_batch`
+        self.batch_depth = 0
+        # Hashes of the old blocks to prune on the next commit
+        self.pending_prunes = []
+
+    def commit(self):
+        """Prune the old blocks added since the last commit and commit the
+        db, unless in a `write_batch`
+        """
+        if self.batch_depth:
+            return
+        if self.pending_prunes:
+            self._prune_blocks(self.pending_prunes)
+            self.pending_prunes = []
+        self.db.commit()
+
+    @contextmanager
+    def write_batch(self):
+        """Group the writes and the pruning of everything done in the block,
+        e.g. adding a run of blocks, into a single commit at the end of it
+
+        If the block raises, nothing is committed by it, but the writes
+        already made stay in the db, to be committed by the next commit.
+        """
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+        self.commit()
+
+    def _prune_blocks(self, block_hashes):
+        """Delete the trie nodes deleted by old blocks, and their journals
+        """
+        rdb = RefcountDB(self.db)
+        for block_hash in block_hashes:
+            try:
+                deletes = self.db.get(b'deletes:' + block_hash)
+                log.debug(
+                    'Deleting up to %d trie nodes' %
+                    (len(deletes) // 32))
+                for i in range(0, len(deletes), 32):
+                    rdb.delete(deletes[i: i + 32])
+                self.db.delete(b'deletes:' + block_hash)
+                self.db.delete(b'changed:' + block_hash)
+            except KeyError as e:
+                log.debug('Failed to prune block {}: {}'.format(encode_hex(block_hash), e))
 
     # Call upon receiving a block
     def add_block(self, block):
@@ -200,20 +259,8 @@ class MainChain(Chain):
         old_block_hash = self.get_blockhash_by_number(
             block.number - self.max_history)
         if old_block_hash:
-            try:
-                deletes = self.db.get(b'deletes:' + old_block_hash)
-                log.debug(
-                    'Deleting up to %d trie nodes' %
-                    (len(deletes) // 32))
-                rdb = RefcountDB(self.db)
-                for i in range(0, len(deletes), 32):
-                    rdb.delete(deletes[i: i + 32])
-                self.db.delete(b'deletes:' + old_block_hash)
-                self.db.delete(b'changed:' + old_block_hash)
-            except KeyError as e:
-                print(e)
-                pass
-        self.db.commit()
+            self.pending_prunes.append(old_block_hash)
+        self.commit()
         assert (b'deletes:' + block.hash) in self.db
         log.info('Added block %d (%s) with %d txs and %d gas' %
                  (block.header.number, encode_hex(block.header.hash)[:8],
@@ -236,25 +283,75 @@ class MainChain(Chain):
                     if i not in missing_collations:
                         missing_collations[i] = {}
                     missing_collations[i].update(missing_collations_map[i])
-                print('[in parent_queue] Reorganizing......')
-                for shard_id in self.shard_id_list:
-                    # FIXME not this self.shard_id_list
-                    collation = collation_map[shard_id] if shard_id in collation_map else None
-                    self.reorganize_head_collation(_blk, collation)
+                log.debug('[in parent_queue] Reorganizing......')
+                self.reorganize_shards(_blk, collation_map)
 
             del self.parent_queue[block.header.hash]
         return True, missing_collations
 
+    def import_blocks(self, blocks, chunk_size=64, callback=None):
+        """Import a run of blocks, e.g. the blocks received from a peer while
+        syncing, committing the db and pruning the old blocks once per
+        `chunk_size` blocks instead of once per block
+
+        Each block has to be the child of the block before it. The import
+        stops before a block that isn't, and after a block that isn't added,
+        e.g. because it is invalid or its parent is missing.
+        `callback(block, success, missing_collations)` is called after each
+        block is passed to `add_block`.
+
+        Returns the number of blocks passed to `add_block` and the missing
+        collations of the added blocks by shard id.
+        """
+        missing_collations = {}
+        for start in range(0, len(blocks), chunk_size):
+            with self.write_batch():
+                for i in range(start, min(start + chunk_size, len(blocks))):
+                    block = blocks[i]
+                    if i > 0 and block.header.prevhash != blocks[i - 1].header.hash:
+                        log.info('Block %d (%s) doesn\'t extend the imported blocks, stopping' %
+                                 (block.number, encode_hex(block.hash[:4])))
+                        return i, missing_collations
+                    success, block_missing_collations = self.add_block(block)
+                    for shard_id in block_missing_collations:
+                        if shard_id not in missing_collations:
+                            missing_collations[shard_id] = {}
+                        missing_collations[shard_id].update(block_missing_collations[shard_id])
+                    if callback is not None:
+                        callback(block, success, block_missing_collations)
+                    if not success:
+                        return i + 1, missing_collations
+        return len(blocks), missing_collations
+
     def init_shard(self, shard_id):
         """Initialize a new ShardChain and add it to MainChain
         """
         if not self.has_shard(shard_id):
             self.shard_id_list.add(shard_id)
-            self.shards[shard_id] = ShardChain(env=self.env, shard_id=shard_id, main_chain=self)
+            self.shards[shard_id] = ShardChain(env=self.mk_shard_env(shard_id), shard_id=shard_id, main_chain=self)
             return True
         else:
             return False
 
+    def mk_shard_env(self, shard_id):
+        """Make the environment of a shard, with a db of its own from
+        `shard_db_factory`, by default in memory, so that the data of a
+        shard can be measured and dropped without touching the others
+        """
+        db = EphemDB() if self.shard_db_factory is None else self.shard_db_factory(shard_id)
+        return Env(db=db, config=self.env.config)
+
+    def drop_shard(self, shard_id):
+        """Stop tracking a shard and drop its data, by dropping its db
+        """
+        if not self.has_shard(shard_id):
+            return False
+        shard = self.shards.pop(shard_id)
+        self.shard_id_list.discard(shard_id)
+        if shard.db is not self.db:
+            drop_db(shard.db)
+        return True
+
     def add_shard(self, shard):
         """Add an existing ShardChain to MainChain
         """
@@ -293,84 +390,134 @@ class MainChain(Chain):
         shard_id = collation.header.shard_id
         collhash = collation.header.hash
 
+        shard = self.shards[shard_id]
+
         # Get the blockhash list of blocks that include the given collation
-        if collhash in self.shards[shard_id].collation_blockhash_lists:
-            blockhash_list = self.shards[shard_id].collation_blockhash_lists[collhash]
-            while blockhash_list:
-                blockhash = blockhash_list.pop(0)
-                given_collation_score = self.shards[shard_id].get_score(collation)
-                head_collation_score = self.shards[shard_id].get_score(self.shards[shard_id].head)
-                if given_collation_score > head_collation_score:
-                    self.shards[shard_id].head_collation_of_block[blockhash] = collhash
-                    block = self.get_block(blockhash)
-                    blockhash_list.extend([b.header.hash for b in self.get_children(block)])
+        if collhash in shard.collation_blockhash_lists:
+            blockhash_list = shard.collation_blockhash_lists.get_hashes(collhash)
+            shard.collation_blockhash_lists[collhash] = b''
+            # Neither score changes while the blocks are updated
+            if shard.get_score(collation) <= shard.get_score(shard.head):
+                return True
+            # Breadth-first over the descendants of the including blocks,
+            # reading the child index instead of decoding the blocks
+            queue = deque(blockhash_list)
+            seen = set(blockhash_list)
+            while queue:
+                blockhash = queue.popleft()
+                shard.head_collation_of_block[blockhash] = collhash
+                for child_hash in self.get_child_hashes(blockhash):
+                    if child_hash not in seen:
+                        seen.add(child_hash)
+                        queue.append(child_hash)
         return True
 
     def reorganize_head_collation(self, block, collation=None):
         """Reorganize head collation
         """
-        # Use alias for clear code
-        blockhash = block.header.hash
-        if collation is None:
-            collhash = shard_id = shard = None
-        else:
-            collhash = collation.header.hash
+        if collation is not None and self.has_shard(collation.header.shard_id) and \
+                collation.header.hash in self.shards[collation.header.shard_id].db:
             shard_id = collation.header.shard_id
-            shard = self.shards[shard_id]
+            self._apply_head_collation(shard_id, block, self._decide_head_collation(shard_id, block, collation))
+        else:
+            # The given block doesn't contain a collation
+            self.reorganize_shards(block)
 
-        # Update collation_blockhash_lists
-        if self.has_shard(shard_id) and collhash and shard.db.get(collhash):
-            shard.collation_blockhash_lists[collhash].append(blockhash)
+    def reorganize_shards(self, block, collation_map=None):
+        """Reorganize the heads of all shards for a new block, given the
+        collations that the block includes by shard id
+
+        The shards are decided independently, on `reorg_pool` if it is set,
+        and the decisions are applied in the order of the shard ids, so the
+        result doesn't depend on the pool.
+        """
+        collation_map = collation_map or {}
+        shard_ids = sorted(self.shards)
+
+        def decide(shard_id):
+            return self._decide_head_collation(shard_id, block, collation_map.get(shard_id))
+        if self.reorg_pool is not None and len(shard_ids) > 1:
+            decisions = self.reorg_pool.map(decide, shard_ids)
+        else:
+            decisions = [decide(shard_id) for shard_id in shard_ids]
+        for shard_id, decision in zip(shard_ids, decisions):
+            self._apply_head_collation(shard_id, block, decision)
+
+    def _decide_head_collation(self, shard_id, block, collation):
+        """Decide the head collation of a block and the head of a shard,
+        only reading the db of the shard, returning the hash of the included
+        collation or None, the head collation of the block and the head
+        """
+        shard = self.shards[shard_id]
+        blockhash = block.header.hash
+        block_prevhash = block.header.prevhash
+        collhash = None
+        if collation is not None and collation.header.hash in shard.db:
+            collhash = collation.header.hash
             # Compare score
             given_coll_score = shard.get_score(collation)
-            prev_head_coll_score = shard.get_head_coll_score(block.header.prevhash)
+            prev_head_coll_score = shard.get_head_coll_score(block_prevhash)
             if given_coll_score > prev_head_coll_score:
-                shard.head_collation_of_block[blockhash] = collhash
+                head_collation = collhash
             else:
-                shard.head_collation_of_block[blockhash] = shard.head_collation_of_block[block.header.prevhash]
-            # Set head
-            shard.head_hash = shard.head_collation_of_block[self.head_hash]
-            shard.state = shard.mk_poststate_of_collation_hash(shard.head_hash)
+                head_collation = shard.head_collation_of_block[block_prevhash]
+        elif block_prevhash in shard.head_collation_of_block:
+            head_collation = shard.head_collation_of_block[block_prevhash]
         else:
-            # The given block doesn't contain a collation
-            self._reorganize_all_shards(block)
+            # The shard was just initialized
+            return None, shard.head_hash, shard.head_hash
+
+        if self.head_hash == blockhash:
+            return collhash, head_collation, head_collation
+        try:
+            return collhash, head_collation, shard.head_collation_of_block[self.head_hash]
+        except KeyError:
+            log.info('head_hash {} not in head_collation_of_block'.format(encode_hex(self.head_hash)))
+            return collhash, head_collation, shard.head_hash
 
-    def _reorganize_all_shards(self, block):
-        """Reorganize all shards' head
+    def _apply_head_collation(self, shard_id, block, decision):
+        """Write a decision of `_decide_head_collation`
         """
+        collhash, head_collation, head_hash = decision
+        shard = self.shards[shard_id]
         blockhash = block.header.hash
-        block_prevhash = block.header.prevhash
-        for k in self.shards:
-            if block_prevhash in self.shards[k].head_collation_of_block:
-                self.shards[k].head_collation_of_block[blockhash] = self.shards[k].head_collation_of_block[block_prevhash]
-                try:
-                    self.shards[k].head_hash = self.shards[k].head_collation_of_block[self.head_hash]
-                except KeyError:
-                    print('head_hash {} not in head_collation_of_block'.format(encode_hex(self.head_hash)))
-            else:
-                # The shard was just initialized
-                self.shards[k].head_collation_of_block[blockhash] = self.shards[k].head_hash
-            self.shards[k].state = self.shards[k].mk_poststate_of_collation_hash(self.shards[k].head_hash)
+        # Update collation_blockhash_lists
+        if collhash is not None:
+            shard.collation_blockhash_lists.append_hash(collhash, blockhash)
+        shard.head_collation_of_block[blockhash] = head_collation
+        # Set head
+        # The state of the shard is made when it is next read, if the head
+        # changed
+        shard.head_hash = head_hash
+        shard.commit()
 
     def handle_ignored_collation(self, collation):
         """Handle the ignored collation (previously ignored collation)
 
         collation: the parent collation
         """
-        if collation.header.hash in self.shards[collation.shard_id].parent_queue:
-            for _collation in self.shards[collation.shard_id].parent_queue[collation.header.hash]:
-                _period_start_prevblock = self.get_block(collation.header.period_start_prevhash)
-                self.shards[collation.shard_id].add_collation(_collation, _period_start_prevblock)
-                del self.shards[collation.shard_id].parent_queue[collation.header.hash]
+        shard = self.shards[collation.shard_id]
+        if shard.released_parents is not None:
+            # Called back by `add_collation` for an orphan added below
+            shard.released_parents.append(collation.header.hash)
+            return
+        # Release the whole subtree of orphans iteratively
+        shard.released_parents = [collation.header.hash]
+        try:
+            while shard.released_parents:
+                parent_hash = shard.released_parents.pop()
+                for _collation in shard.orphan_pool.pop_children(parent_hash):
+                    _period_start_prevblock = self.get_block(_collation.header.period_start_prevhash)
+                    shard.add_collation(_collation, _period_start_prevblock)
+        finally:
+            shard.released_parents = None
 
     def append_log_listener(self):
         """ Append log_listeners
         """
         def header_log_listener(log):
-            print('log:{}'.format(log))
-            for x in log.topics:
-                if x == big_endian_to_int(ADD_HEADER_TOPIC):
-                    self.add_header_logs.append(log.data)
+            if add_header_topic in log.topics:
+                self.add_header_logs.append(log.data)
         self.state.log_listeners.append(header_log_listener)
 
     def parse_add_header_logs(self, block):
@@ -378,16 +525,14 @@ class MainChain(Chain):
         """
         collation_map = {}
         missing_collations_map = {}
-        for item in self.add_header_logs:
-            log.info('Got log item form self.add_header_logs!')
-            # [num, num, bytes32, bytes32, bytes32, address, bytes32, bytes32, bytes]
-            # use sedes to prevent integer 0 from being decoded as b''
-            sedes = List([utils.big_endian_int, utils.big_endian_int, hash32, hash32, hash32, utils.address, hash32, hash32, utils.big_endian_int, binary])
-            values = rlp.decode(item, sedes)
-            shard_id = values[0]
-            log.info("add_header: shard_id={}, expected_period_number={}, header_hash={}, parent_header_hash={}".format(values[0], values[1], encode_hex(utils.sha3(item)), encode_hex(values[3])))
-            if shard_id in self.shard_id_list and self.shards[shard_id].active:
-                collation_hash = sha3(item)
+        headers = decode_add_header_logs(self.add_header_logs)
+        self.add_header_logs_seen += len(self.add_header_logs)
+        for shard_id, collation_hashes in headers.items():
+            if shard_id not in self.shard_id_list or not self.shards[shard_id].active:
+                continue
+            self.add_header_logs_watched += len(collation_hashes)
+            for collation_hash in collation_hashes:
+                log.debug('add_header: shard_id={}, header_hash={}'.format(shard_id, encode_hex(collation_hash)))
                 collation = self.shards[shard_id].get_collation(collation_hash)
                 if collation is None:
                     # Getting add_header before getting collation
@@ -0,0 +1,126 @@
+import time
+from collections import OrderedDict
+import rlp
+
+from ethereum.slogging import get_logger
+
+log = get_logger('sharding.orphan_pool')
+
+
+class OrphanPool(object):
+    """Collations received before their parent, indexed by parent hash
+
+    The pool holds at most `max_count` collations and `max_bytes` bytes of
+    header and transaction RLP, dropping the oldest collations first, and
+    drops collations whose `expected_period_number` is more than
+    `max_age_periods` behind the latest period it has seen.
+
+    :param max_count: the maximum number of collations
+    :param max_bytes: the maximum total size of the collations
+    :param max_age_periods: the number of periods a collation is kept for
+    """
+
+    def __init__(self, max_count=1024, max_bytes=16 * 1024 * 1024, max_age_periods=64):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_age_periods = max_age_periods
+        # collation hash -> (collation, size, time added), oldest first
+        self.entries = OrderedDict()
+        # parent collation hash -> [collation hash]
+        self.children = {}
+        self.size_bytes = 0
+        self.latest_period = 0
+
+        self.added = 0
+        self.duplicates = 0
+        self.evicted = 0
+        self.expired = 0
+        self.resolved = 0
+        self.resolved_age_total = 0.0
+        self.resolved_age_max = 0.0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, collation_hash):
+        return collation_hash in self.entries
+
+    def add(self, collation):
+        """Add a collation whose parent is missing, returning whether it is
+        kept, i.e. False for duplicates and collations that are too old or
+        too large
+        """
+        collation_hash = collation.header.hash
+        if collation_hash in self.entries:
+            self.duplicates += 1
+            return False
+        period = collation.header.expected_period_number
+        if period < self.latest_period - self.max_age_periods:
+            self.expired += 1
+            return False
+        size = len(rlp.encode(collation.header)) + len(collation.transactions_rlp)
+        self.entries[collation_hash] = (collation, size, time.time())
+        self.children.setdefault(collation.header.parent_collation_hash, []).append(collation_hash)
+        self.size_bytes += size
+        self.added += 1
+
+        if period > self.latest_period:
+            self.latest_period = period
+            self.expire(period - self.max_age_periods)
+        while len(self.entries) > self.max_count or self.size_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evicted += 1
+        return collation_hash in self.entries
+
+    def _remove(self, collation_hash):
+        collation, size, added_at = self.entries.pop(collation_hash)
+        parent_hash = collation.header.parent_collation_hash
+        siblings = self.children[parent_hash]
+        siblings.remove(collation_hash)
+        if not siblings:
+            del self.children[parent_hash]
+        self.size_bytes -= size
+        return collation, added_at
+
+    def expire(self, period):
+        """Drop the collations of periods before `period`
+        """
+        expired = [collation_hash for collation_hash, (collation, _, _) in self.entries.items()
+                   if collation.header.expected_period_number < period]
+        for collation_hash in expired:
+            self._remove(collation_hash)
+        self.expired += len(expired)
+        if expired:
+            log.debug('Expired %d orphan collations before period %d' % (len(expired), period))
+        return len(expired)
+
+    def pop_children(self, parent_hash):
+        """Remove and return the collations waiting for a given parent, in
+        the order in which they were added
+        """
+        now = time.time()
+        collations = []
+        for collation_hash in list(self.children.get(parent_hash, [])):
+            collation, added_at = self._remove(collation_hash)
+            age = now - added_at
+            self.resolved += 1
+            self.resolved_age_total += age
+            self.resolved_age_max = max(self.resolved_age_max, age)
+            collations.append(collation)
+        return collations
+
+    def stats(self):
+        """Get the size of the pool and the counters, with the ages of
+        resolved orphans in seconds
+        """
+        return {
+            'count': len(self.entries),
+            'bytes': self.size_bytes,
+            'added': self.added,
+            'duplicates': self.duplicates,
+            'evicted': self.evicted,
+            'expired': self.expired,
+            'resolved': self.resolved,
+            'resolved_age_mean': self.resolved_age_total / self.resolved if self.resolved else 0.0,
+            'resolved_age_max': self.resolved_age_max,
+        }
@@ -1,7 +1,9 @@
+import copy
 import time
 import json
 import logging
-from collections import defaultdict
+from collections import OrderedDict
+from contextlib import contextmanager
 import rlp
 
 from ethereum.exceptions import (
@@ -10,7 +12,8 @@ from ethereum.exceptions import (
 )
 from ethereum.slogging import get_logger
 from ethereum.config import Env
-from ethereum.state import State
+from ethereum.db import RefcountDB
+from ethereum.state import State, STATE_DEFAULTS
 from ethereum.pow.consensus import initialize
 from ethereum.utils import (
     encode_hex,
@@ -21,13 +24,23 @@ from ethereum.utils import (
 from sharding.collation import (
     CollationHeader,
     Collation,
+    decode_header,
+    intern_collation,
+    is_legacy_collation_rlp,
+    is_packed_header,
+    pack_header,
+    unpack_header,
 )
 from sharding.collator import apply_collation
+from sharding.db import db_size
+from sharding.header_store import HeaderStore
+from sharding.orphan_pool import OrphanPool
 from sharding.state_transition import (
     update_collation_env_variables,
     set_collation_gas_limit,
 )
 from sharding.validator_manager_utils import call_valmgr
+from sharding.windowed_index import WindowedIndex
 
 log = get_logger('sharding.shard_chain')
 log.setLevel(logging.DEBUG)
@@ -51,26 +64,37 @@ def initialize_genesis_keys(state, genesis, shard_id):
 class ShardChain(object):
     def __init__(self, shard_id, env=None,
                  new_head_cb=None, reset_genesis=False, localtime=None, max_history=1000,
-                 initial_state=None, main_chain=None, **kwargs):
+                 initial_state=None, main_chain=None, packed_headers=False, state_cache_size=64,
+                 block_window=1000, header_store=False, **kwargs):
         self.env = env or Env()
         self.shard_id = shard_id
+        # Nesting depth of `write_batch`
+        self.batch_depth = 0
+        # Store headers in the packed format instead of RLP, see `pack_header`
+        self.packed_headers = packed_headers
+        # Snapshots of post-states, see `mk_poststate_of_collation_hash`
+        self.state_cache = OrderedDict()
+        self.state_cache_size = state_cache_size
+        self.genesis_snapshot = None
         self.active = False
         self.is_syncing = True
 
-        self.collation_blockhash_lists = defaultdict(list)    # M1: collation_header_hash -> list[blockhash]
-        self.head_collation_of_block = {}   # M2: blockhash -> head_collation
         self.main_chain = main_chain
 
         # Initialize the state
         head_hash_key = b'shard_' + to_string(shard_id) + b'_head_hash'
+        self._head_hash = None
+        self._head = None
+        self._state = None
         if head_hash_key in self.db:  # new head tag
-            self.state = self.mk_poststate_of_collation_hash(self.db.get(head_hash_key))
+            self.head_hash = self.db.get(head_hash_key)
+            self.state = self.mk_poststate_of_collation_hash(self.head_hash)
             log.info(
                 'Initializing shard chain from saved head, #%d (%s)' %
-                (self.state.prev_headers[0].number, encode_hex(self.state.prev_headers[0].hash)))
-            self.head_hash = self.state.prev_headers[0].hash
+                (self.head.number, encode_hex(self.head_hash)))
         else:
             # no head_hash in db -> empty shard chain
+            self.head_hash = self.env.config['GENESIS_PREVHASH']
             if initial_state is not None and isinstance(initial_state, State):
                 # Normally, initial_state is for testing
                 assert env is None
@@ -81,7 +105,6 @@ class ShardChain(object):
                 self.state = State(env=self.env)
                 self.last_state = self.state.to_snapshot()
 
-            self.head_hash = self.env.config['GENESIS_PREVHASH']
             self.db.put(self.head_hash, b'GENESIS')
             self.db.put(head_hash_key, self.head_hash)
 
@@ -93,6 +116,15 @@ class ShardChain(object):
 
         assert self.env.db == self.state.db
 
+        # Kept in the db for the latest `block_window` blocks and collations,
+        # under the shard id since shards may share a db
+        # M1: collation_header_hash -> concatenated blockhashes
+        self.collation_blockhash_lists = WindowedIndex(
+            self.db, b'coll_blocks:' + to_string(shard_id) + b':', block_window)
+        # M2: blockhash -> head_collation
+        self.head_collation_of_block = WindowedIndex(
+            self.db, b'head_coll:' + to_string(shard_id) + b':', block_window)
+
         initialize(self.state)
         # Collation Gas Limit
         gas_limit = call_valmgr(self.main_chain.state, 'get_collation_gas_limit', [])
@@ -102,31 +134,89 @@ class ShardChain(object):
         if reset_genesis:
             initialize_genesis_keys(self.state, Collation(CollationHeader()), self.shard_id)
 
+        # Columnar header store for history scans, see `HeaderStore`. It
+        # needs numpy, holds every header added and is filled from the whole
+        # canonical chain on init, so it is off unless asked for.
+        self.header_store = None
+        if header_store:
+            self.header_store = HeaderStore()
+            if not reset_genesis:
+                self._load_header_store()
+
         self.time_queue = []
-        self.parent_queue = {}
+        # Collations waiting for their parent
+        self.orphan_pool = OrphanPool()
+        # Parent hashes whose orphans are being added, see
+        # `MainChain.handle_ignored_collation`
+        self.released_parents = None
+        # State of `repair_score_index`
+        self.score_index_repaired = False
+        self._score_repair = None
         self.localtime = time.time() if localtime is None else localtime
+        # Depth at which collations are pruned, None to keep all state
         self.max_history = max_history
 
     @property
     def db(self):
         return self.env.db
 
+    def db_size(self):
+        """Get the size of the data in the db of this shard, in bytes
+        """
+        return db_size(self.db)
+
+    def commit(self):
+        """Commit the db, unless in a `write_batch`
+        """
+        if not self.batch_depth:
+            self.db.commit()
+
+    @contextmanager
+    def write_batch(self):
+        """Group the writes of everything done in the block, e.g. adding a run
+        of collations, into a single commit at the end of it
+
+        If the block raises, nothing is committed by it, but the writes
+        already made stay in the db, to be committed by the next commit.
+        """
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+        self.commit()
+
+    @property
+    def head_hash(self):
+        return self._head_hash
+
+    @head_hash.setter
+    def head_hash(self, value):
+        if value != self._head_hash:
+            self._head_hash = value
+            self._head = None
+            self._state = None
+
+    @property
+    def state(self):
+        """post-state of the head collation, made when it is first read
+        after the head changes
+        """
+        if self._state is None:
+            self._state = self.mk_poststate_of_collation_hash(self._head_hash)
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        self._state = value
+
     @property
     def head(self):
-        """head collation
+        """head collation, decoded once per head hash
         """
-        try:
-            collation_rlp = self.db.get(self.head_hash)
-            # [TODO] no genesis collation
-            if collation_rlp == 'GENESIS':
-                return Collation(CollationHeader())
-                # return self.genesis
-            else:
-                return rlp.decode(collation_rlp, Collation)
-            return rlp.decode(collation_rlp, Collation)
-        except Exception as e:
-            log.info(str(e))
-            return None
+        if self._head is None:
+            self._head = self.get_collation(self._head_hash)
+        return self._head
 
     def add_collation(self, collation, period_start_prevblock):
         """Add collation to db and update score
@@ -137,6 +227,11 @@ class ShardChain(object):
                 (encode_hex(collation.header.hash), encode_hex(collation.header.parent_collation_hash)))
             if self.is_first_collation(collation):
                 log.debug('It is the first collation of shard {}'.format(self.shard_id))
+            collation_score = self.get_score_of_hash(collation.header.parent_collation_hash) + 1
+            if collation_score != collation.header.number:
+                log.info('Collation %s has number %d, but its score is %d' %
+                         (encode_hex(collation.header.hash), collation.header.number, collation_score))
+                return False
             temp_state = self.mk_poststate_of_collation_hash(collation.header.parent_collation_hash)
             try:
                 apply_collation(
@@ -152,7 +247,6 @@ class ShardChain(object):
                 return False
             deletes = temp_state.deletes
             changed = temp_state.changed
-            collation_score = self.get_score(collation)
             log.info('collation_score of {} is {}'.format(encode_hex(collation.header.hash), collation_score))
         # Collation has no parent yet
         else:
@@ -161,22 +255,34 @@ class ShardChain(object):
             log.info(
                 'Receiving collation(%s) which its parent is NOT in db: %s' %
                 (encode_hex(collation.header.hash), encode_hex(collation.header.parent_collation_hash)))
-            if collation.header.parent_collation_hash not in self.parent_queue:
-                self.parent_queue[collation.header.parent_collation_hash] = []
-            self.parent_queue[collation.header.parent_collation_hash].append(collation)
-            log.info('No parent found. Delaying for now')
+            if self.orphan_pool.add(collation):
+                log.info('No parent found. Delaying for now')
             return False
-        self.db.put(collation.header.hash, rlp.encode(collation))
-
-        self.db.put(b'changed:' + collation.hash, b''.join(list(changed.keys())))
+        self._put_collation(collation)
+        # Committed together with the collation, so that every stored
+        # collation has its score and ancestor index
+        self.db.put(b'score:' + collation.header.hash, to_string(collation_score))
+        if self._has_skiplist(collation.header.parent_collation_hash):
+            self._put_skiplist(collation.header)
+
+        # Empty journals are not stored
+        if changed:
+            self.db.put(b'changed:' + collation.hash, b''.join(list(changed.keys())))
         # log.debug('Saved %d address change logs' % len(changed.keys()))
-        self.db.put(b'deletes:' + collation.hash, b''.join(deletes))
+        if deletes:
+            self.db.put(b'deletes:' + collation.hash, b''.join(deletes))
         # log.debug('Saved %d trie node deletes for collation (%s)' % (len(deletes), encode_hex(collation.hash)))
 
-        # TODO: Delete old junk data
-        # deletes, changed
+        # Delete old junk data
+        if self.max_history is not None:
+            old_collation_hash = self.get_ancestor_hash(collation.header.hash, self.max_history)
+            if old_collation_hash is not None:
+                reclaimed = self._prune_collation(old_collation_hash)
+                log.debug('Pruned collation %s, reclaimed %d bytes' % (encode_hex(old_collation_hash), reclaimed))
 
-        self.db.commit()
+        self.commit()
+        if self.header_store is not None:
+            self.header_store.add(collation.header, collation_score)
         log.info(
             'Added collation (%s) with %d txs' %
             (encode_hex(collation.header.hash)[:8],
@@ -202,21 +308,59 @@ class ShardChain(object):
 
     def mk_poststate_of_collation_hash(self, collation_hash):
         """Return the post-state of the collation
+
+        Every call returns a new `State`, which the caller may modify. The
+        post-states of recent collations are cached as a state root and the
+        other state variables, and the genesis state is parsed once.
+        """
+        snapshot = self.state_cache.pop(collation_hash, None)
+        if snapshot is not None:
+            state = self._state_from_snapshot(snapshot)
+        else:
+            state = self._mk_poststate(collation_hash)
+            snapshot = self._snapshot_of_state(state)
+        # Insert as the most recently used
+        self.state_cache[collation_hash] = snapshot
+        while len(self.state_cache) > self.state_cache_size:
+            self.state_cache.popitem(last=False)
+        return state
+
+    def _snapshot_of_state(self, state):
+        """Take the state root and the other state variables of a committed
+        state, like `State.to_snapshot(root_only=True)` without the
+        conversion to and from strings
         """
+        return state.trie.root_hash, {k: copy.copy(getattr(state, k)) for k in STATE_DEFAULTS}
+
+    def _state_from_snapshot(self, snapshot):
+        root_hash, variables = snapshot
+        state = State(env=self.env)
+        state.trie.root_hash = root_hash
+        for k, v in variables.items():
+            setattr(state, k, copy.copy(v))
+        return state
+
+    def _mk_poststate(self, collation_hash):
         if collation_hash not in self.db:
             raise Exception("Collation hash %s not found" % encode_hex(collation_hash))
 
-        collation_rlp = self.db.get(collation_hash)
-        if collation_rlp == b'GENESIS':
-            return State.from_snapshot(json.loads(self.db.get(b'SHARD_' + to_string(self.shard_id) + b'_GENESIS_STATE')), self.env)
-        collation = rlp.decode(collation_rlp, Collation)
+        if self.db.get(collation_hash) == b'GENESIS':
+            if self.genesis_snapshot is None:
+                # The trie of the genesis state is committed to the db by
+                # the first `from_snapshot`, after that its root is enough with
+                # the other state variables
+                state = State.from_snapshot(json.loads(self.db.get(b'SHARD_' + to_string(self.shard_id) + b'_GENESIS_STATE')), self.env)
+                self.genesis_snapshot = self._snapshot_of_state(state)
+                return state
+            return self._state_from_snapshot(self.genesis_snapshot)
+        collation = self._read_collation(collation_hash)
 
         state = State(env=self.env)
         state.trie.root_hash = collation.header.post_state_root
 
         update_collation_env_variables(state, collation)
         state.gas_used = 0
-        state.txindex = len(collation.transactions)
+        state.txindex = collation.transaction_count
         state.recent_uncles = {}
         state.prev_headers = []
 
@@ -234,36 +378,298 @@ class ShardChain(object):
         """Get the collation with a given collation hash
         """
         try:
-            collation_rlp = self.db.get(collation_hash)
-            if collation_rlp == b'GENESIS':
-                return Collation(CollationHeader())
-                # if not hasattr(self, 'genesis'):
-                #     self.genesis = rlp.decode(self.db.get(b'GENESIS_RLP'), sedes=Block)
-                # return self.genesis
-            else:
-                return rlp.decode(collation_rlp, Collation)
+            return self._read_collation(collation_hash)
         except Exception as e:
             log.debug("Failed to get collation", hash=encode_hex(collation_hash), error=str(e))
             return None
 
+    def get_collation_header(self, collation_hash):
+        """Get the header of the collation with a given collation hash,
+        without reading the collation body
+        """
+        try:
+            header_data = self.db.get(collation_hash)
+            if header_data == b'GENESIS':
+                return CollationHeader()
+            else:
+                return self._decode_header(collation_hash, header_data)
+        except Exception as e:
+            log.debug("Failed to get collation header", hash=encode_hex(collation_hash), error=str(e))
+            return None
+
+    def _read_collation(self, collation_hash):
+        header_data = self.db.get(collation_hash)
+        if header_data == b'GENESIS':
+            return Collation(CollationHeader())
+            # if not hasattr(self, 'genesis'):
+            #     self.genesis = rlp.decode(self.db.get(b'GENESIS_RLP'), sedes=Block)
+            # return self.genesis
+        elif not is_packed_header(header_data) and is_legacy_collation_rlp(header_data):
+            return self._migrate_legacy_collation(collation_hash, header_data)
+        else:
+            return intern_collation(Collation.from_serialized_transactions(
+                self._decode_header(collation_hash, header_data),
+                self.db.get(b'collation_body:' + collation_hash),
+            ))
+
+    def _decode_header(self, collation_hash, header_data):
+        """Decode a header stored in either format, or in a legacy collation
+        """
+        if is_packed_header(header_data):
+            return unpack_header(header_data, collation_hash)
+        elif is_legacy_collation_rlp(header_data):
+            return self._migrate_legacy_collation(collation_hash, header_data).header
+        else:
+            return decode_header(header_data)
+
+    def _put_collation(self, collation):
+        """Store the collation header under the collation hash and the
+        transaction list under a separate body key
+        """
+        collhash = collation.header.hash
+        if self.packed_headers:
+            self.db.put(collhash, pack_header(collation.header))
+        else:
+            self.db.put(collhash, rlp.encode(collation.header))
+        self.db.put(b'collation_body:' + collhash, collation.transactions_rlp)
+
+    def _migrate_legacy_collation(self, collation_hash, collation_rlp):
+        """Split a whole collation stored under its hash by an older version
+        into the header and body keys
+        """
+        collation = Collation.lazy_decode(collation_rlp)
+        self._put_collation(collation)
+        log.debug('Migrated collation %s to separate header and body keys' % encode_hex(collation_hash))
+        return collation
+
+    def iter_headers(self, collation_hash=None):
+        """Iterate over the headers of a collation, by default the head, and
+        of its ancestors down to the first collation
+        """
+        genesis_prevhash = self.env.config['GENESIS_PREVHASH']
+        if collation_hash is None:
+            collation_hash = self.head_hash
+        while collation_hash != genesis_prevhash:
+            header = self.get_collation_header(collation_hash)
+            if header is None:
+                break
+            yield header
+            collation_hash = header.parent_collation_hash
+
+    def _get_number(self, collation_hash):
+        if collation_hash == self.env.config['GENESIS_PREVHASH']:
+            return 0
+        header = self.get_collation_header(collation_hash)
+        return None if header is None else header.number
+
+    def _has_skiplist(self, collation_hash):
+        return collation_hash == self.env.config['GENESIS_PREVHASH'] or b'skiplist:' + collation_hash in self.db
+
+    def _read_skiplist(self, collation_hash):
+        if collation_hash == self.env.config['GENESIS_PREVHASH']:
+            return []
+        data = self.db.get(b'skiplist:' + collation_hash)
+        return [data[i:i + 32] for i in range(0, len(data), 32)]
+
+    def _put_skiplist(self, header):
+        """Store the hashes of the ancestors of a header at distances 1, 2,
+        4, ... down to the genesis, from the entries of its ancestors
+
+        The entries stop at the collation that `set_head` started from,
+        since its ancestors are not stored.
+        """
+        ancestors = [header.parent_collation_hash]
+        while 2 ** len(ancestors) <= header.number:
+            level = len(ancestors) - 1
+            if not self._has_skiplist(ancestors[-1]):
+                break
+            parent_ancestors = self._read_skiplist(ancestors[-1])
+            if len(parent_ancestors) <= level:
+                break
+            ancestors.append(parent_ancestors[level])
+        self.db.put(b'skiplist:' + header.hash, b''.join(ancestors))
+        return ancestors
+
+    def _get_skiplist(self, collation_hash):
+        """Get the ancestor hashes stored by `_put_skiplist`, storing the
+        missing entries of collations added by an older version, or None if
+        an ancestor is missing
+        """
+        if self._has_skiplist(collation_hash):
+            return self._read_skiplist(collation_hash)
+        headers = []
+        while not self._has_skiplist(collation_hash):
+            header = self.get_collation_header(collation_hash)
+            if header is None:
+                return None
+            headers.append(header)
+            collation_hash = header.parent_collation_hash
+        for header in reversed(headers):
+            ancestors = self._put_skiplist(header)
+        return ancestors
+
+    def get_ancestor_hash(self, collation_hash, depth):
+        """Get the hash of the ancestor `depth` collations back from a given
+        collation, in O(log(depth)) reads, or None if there is none
+
+        The ancestor at the depth of the collation number is the genesis,
+        i.e. `GENESIS_PREVHASH`. Ancestors behind the collation that
+        `set_head` started from are not found.
+        """
+        number = self._get_number(collation_hash)
+        if number is None or not 0 <= depth <= number:
+            return None
+        level = 0
+        while depth:
+            if depth & 1:
+                ancestors = self._get_skiplist(collation_hash)
+                if ancestors is None or level >= len(ancestors):
+                    return None
+                collation_hash = ancestors[level]
+            depth >>= 1
+            level += 1
+        return collation_hash
+
+    def get_common_ancestor(self, collation_hash1, collation_hash2):
+        """Get the hash of the latest common ancestor of two collations, in
+        O(log(number)) reads, or None if an ancestor is missing
+        """
+        number1 = self._get_number(collation_hash1)
+        number2 = self._get_number(collation_hash2)
+        if number1 is None or number2 is None:
+            return None
+        if number1 > number2:
+            collation_hash1 = self.get_ancestor_hash(collation_hash1, number1 - number2)
+        elif number2 > number1:
+            collation_hash2 = self.get_ancestor_hash(collation_hash2, number2 - number1)
+        if collation_hash1 is None or collation_hash2 is None:
+            return None
+        if collation_hash1 == collation_hash2:
+            return collation_hash1
+
+        # Both collations have the same number, and so the same levels
+        ancestors1 = self._get_skiplist(collation_hash1)
+        ancestors2 = self._get_skiplist(collation_hash2)
+        if ancestors1 is None or ancestors2 is None:
+            return None
+        for level in reversed(range(len(ancestors1))):
+            if level < min(len(ancestors1), len(ancestors2)) and ancestors1[level] != ancestors2[level]:
+                ancestors1 = self._read_skiplist(ancestors1[level])
+                ancestors2 = self._read_skiplist(ancestors2[level])
+        return ancestors1[0]
+
+    def _prune_collation(self, collation_hash):
+        """Delete the trie nodes that a collation replaced, which are only
+        needed by the post-state of its parent, and its journals
+
+        Returns the number of bytes reclaimed, counting the keys and values
+        deleted from the db.
+        """
+        reclaimed = 0
+        try:
+            deletes = self.db.get(b'deletes:' + collation_hash)
+        except KeyError:
+            deletes = b''
+        else:
+            rdb = RefcountDB(self.db)
+            for i in range(0, len(deletes), 32):
+                key = deletes[i: i + 32]
+                try:
+                    if rdb.get_refcount(key) == 1:
+                        reclaimed += len(key) + len(self.db.get(key))
+                    rdb.delete(key)
+                except KeyError:
+                    pass
+            self.db.delete(b'deletes:' + collation_hash)
+            reclaimed += len(b'deletes:' + collation_hash) + len(deletes)
+        try:
+            changed = self.db.get(b'changed:' + collation_hash)
+        except KeyError:
+            pass
+        else:
+            self.db.delete(b'changed:' + collation_hash)
+            reclaimed += len(b'changed:' + collation_hash) + len(changed)
+        return reclaimed
+
+    def prune(self, max_history=None):
+        """Prune the collations of the head chain that are more than
+        `max_history` collations, by default `self.max_history`, behind the
+        head, e.g. on a database written with pruning disabled
+
+        Returns the number of bytes reclaimed.
+        """
+        if max_history is None:
+            max_history = self.max_history
+        if max_history is None:
+            raise ValueError('max_history is required when pruning is disabled')
+        reclaimed = 0
+        collation_hash = self.get_ancestor_hash(self.head_hash, max_history)
+        if collation_hash is not None:
+            for header in self.iter_headers(collation_hash):
+                reclaimed += self._prune_collation(header.hash)
+        self.commit()
+        log.info('Pruned shard %d, reclaimed %d bytes' % (self.shard_id, reclaimed))
+        return reclaimed
+
+    def migrate_collation_storage(self):
+        """Migrate the collations from the head back to the first collation
+        to separate header and body keys
+
+        Collations on other branches are migrated when they are first read.
+        """
+        for _ in self.iter_headers():
+            pass
+        self.commit()
+
+    def _load_header_store(self):
+        """Fill the header store with the collations from the first one to
+        the saved head
+        """
+        for header in reversed(list(self.iter_headers())):
+            self.header_store.add(header, self._get_header_score(header))
+
     def get_score(self, collation):
         """Get the score of a given collation
         """
-        score = 0
-
         if not collation:
             return 0
-        key = b'score:' + collation.header.hash
+        try:
+            return int(self.db.get(b'score:' + collation.header.hash))
+        except KeyError:
+            return self._get_header_score(collation.header)
+
+    def get_score_of_hash(self, collation_hash):
+        """Get the score of the collation with a given collation hash
+        """
+        try:
+            return int(self.db.get(b'score:' + collation_hash))
+        except KeyError:
+            header = self.get_collation_header(collation_hash)
+            if header is None:
+                raise
+            return self._get_header_score(header)
+
+    def _get_header_score(self, header):
+        """Get the score of a header by walking back to the nearest ancestor
+        with a score, for databases written before scores were stored on
+        insertion, and store the scores on the way
+        """
+        score = 0
+
+        key = b'score:' + header.hash
 
         fills = []
 
-        while key not in self.db and collation is not None:
-            fills.insert(0, collation.header.hash)
-            key = b'score:' + collation.header.parent_collation_hash
-            collation = self.get_parent(collation)
+        while key not in self.db and header is not None:
+            fills.insert(0, header.hash)
+            key = b'score:' + header.parent_collation_hash
+            if header.parent_collation_hash == self.env.config['GENESIS_PREVHASH']:
+                header = None
+            else:
+                header = self.get_collation_header(header.parent_collation_hash)
 
         score = int(self.db.get(key))
-        log.debug('int(self.db.get(key)):{}'.format(int(self.db.get(key))))
+        log.debug('int(self.db.get(key)):{}'.format(score))
 
         for h in fills:
             key = b'score:' + h
@@ -275,12 +681,58 @@ class ShardChain(object):
     def get_head_coll_score(self, blockhash):
         if blockhash in self.head_collation_of_block:
             prev_head_coll_hash = self.head_collation_of_block[blockhash]
-            prev_head_coll = self.get_collation(prev_head_coll_hash)
-            prev_head_coll_score = self.get_score(prev_head_coll)
+            try:
+                prev_head_coll_score = self.get_score_of_hash(prev_head_coll_hash)
+            except KeyError:
+                prev_head_coll_score = 0
         else:
             prev_head_coll_score = 0
         return prev_head_coll_score
 
+    def repair_score_index(self, budget=1000):
+        """Store the missing scores of a database written before scores were
+        stored on insertion, reading at most `budget` headers per call so that
+        it can run in the background, e.g. once per tick
+
+        The chains of the head and of the collations known from the main chain
+        are repaired. Returns True when they are done.
+        """
+        if self.score_index_repaired:
+            return True
+        if self._score_repair is None:
+            self._score_repair = self._iter_score_repair()
+        for _ in range(budget):
+            if next(self._score_repair, None) is None:
+                self._score_repair = None
+                self.score_index_repaired = True
+                break
+        self.commit()
+        return self.score_index_repaired
+
+    def _iter_score_repair(self):
+        """Yield True for every header read while storing missing scores
+        """
+        start_hashes = [self.head_hash]
+        start_hashes.extend(self.collation_blockhash_lists)
+        start_hashes.extend(self.head_collation_of_block.values())
+        for collation_hash in start_hashes:
+            headers = []
+            while b'score:' + collation_hash not in self.db:
+                header = self.get_collation_header(collation_hash)
+                yield True
+                if header is None:
+                    break
+                headers.append(header)
+                collation_hash = header.parent_collation_hash
+            else:
+                score = int(self.db.get(b'score:' + collation_hash))
+                for header in reversed(headers):
+                    score += 1
+                    if score != header.number:
+                        log.info('Collation %s has number %d, but its score is %d' %
+                                 (encode_hex(header.hash), header.number, score))
+                    self.db.put(b'score:' + header.hash, to_string(score))
+
     def is_first_collation(self, collation):
         """Check if the given collation is the first collation of this shard
         """
@@ -296,10 +748,16 @@ class ShardChain(object):
         """ Set head state and collation
         """
         try:
-            self.state = state
             self.head_hash = collation.hash
-            self.db.put(collation.hash, rlp.encode(collation))
-            self.db.put(b'score:' + collation.hash, collation.number)
+            self.state = state
+            self._put_collation(collation)
+            self.db.put(b'score:' + collation.hash, to_string(collation.number))
+            # The ancestors are not stored, so the ancestor index starts
+            # here, for `get_ancestor_hash` and pruning to find the
+            # collations added on top
+            self.db.put(b'skiplist:' + collation.hash, collation.header.parent_collation_hash)
+            if self.header_store is not None:
+                self.header_store.add(collation.header, collation.number)
         except (AttributeError, TypeError) as e:
             log.info('Failed to sync shard data: {}'.format(str(e)))
             return False
@@ -307,8 +765,8 @@ class ShardChain(object):
 
     def collation_blockhash_lists_to_dict(self):
         output = {}
-        for collhash, b_list in self.collation_blockhash_lists.items():
-            output[encode_hex(collhash)] = [encode_hex(b) for b in b_list]
+        for collhash in self.collation_blockhash_lists:
+            output[encode_hex(collhash)] = [encode_hex(b) for b in self.collation_blockhash_lists.get_hashes(collhash)]
         return output
 
     def head_collation_of_block_to_dict(self):
@@ -0,0 +1,137 @@
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from ethereum import utils
+from ethereum.transactions import secpk1n
+
+
+def verify_signature(signing_hash, sig, address):
+    """Check a signature made by `contract_utils.sign`, i.e. v, r and s as
+    32 bytes each, against the address of the expected signer
+    """
+    try:
+        sig = utils.to_string(sig)
+        if len(sig) != 96:
+            return False
+        v = utils.big_endian_to_int(sig[:32])
+        r = utils.big_endian_to_int(sig[32:64])
+        s = utils.big_endian_to_int(sig[64:])
+        if v not in (27, 28) or not (0 < r < secpk1n and 0 < s < secpk1n):
+            return False
+        pub = utils.ecrecover_to_pub(signing_hash, v, r, s)
+        return utils.sha3(pub)[-20:] == utils.normalize_address(address)
+    except Exception:
+        return False
+
+
+def _verify_triple(triple):
+    return verify_signature(*triple)
+
+
+class SignatureVerifier(object):
+    """Verify `(signing_hash, sig, address)` triples locally, caching the
+    results in an LRU keyed by signing hash, so that a header received from
+    many peers is verified once
+
+    It also remembers the headers that passed `verify_collation_header`,
+    keyed by header hash and main chain head, so that the headers relayed
+    again before the next block skip the `add_header` call.
+
+    :param cache_size: the number of signing hashes, and of verified headers,
+                       to keep results for
+    :param processes: the number of worker processes to verify batches with,
+                      if `pool` is not given; 0 verifies in this process
+    :param pool: a `multiprocessing.Pool` to verify batches with, which can be
+                 shared between verifiers
+    """
+
+    def __init__(self, cache_size=4096, processes=0, pool=None):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.verified_headers = OrderedDict()
+        self.header_hits = 0
+        self._owns_pool = pool is None and processes > 0
+        self.pool = Pool(processes) if self._owns_pool else pool
+
+    def _get_cached(self, signing_hash, sig, address):
+        entry = self.cache.pop(signing_hash, None)
+        if entry is None:
+            return None
+        # Re-insert as the most recently used
+        self.cache[signing_hash] = entry
+        if entry[:2] != (sig, address):
+            return None
+        return entry[2]
+
+    def _put_cached(self, signing_hash, sig, address, result):
+        entry = self.cache.get(signing_hash)
+        if entry is not None and entry[2] and not result:
+            # Keep a valid signature rather than a bad one relayed later
+            return
+        self.cache.pop(signing_hash, None)
+        self.cache[signing_hash] = (sig, address, result)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def verify(self, signing_hash, sig, address):
+        """Check one signature, see `verify_signature`
+        """
+        return self.verify_many([(signing_hash, sig, address)])[0]
+
+    def verify_many(self, triples):
+        """Check a batch of `(signing_hash, sig, address)` triples, in the
+        worker processes if there are any, returning a list of booleans
+        """
+        triples = list(triples)
+        results = [None] * len(triples)
+        pending = OrderedDict()
+        for i, triple in enumerate(triples):
+            cached = self._get_cached(*triple)
+            if cached is None:
+                pending.setdefault(triple, []).append(i)
+            else:
+                self.hits += 1
+                results[i] = cached
+
+        if pending:
+            self.misses += len(pending)
+            if self.pool is not None and len(pending) > 1:
+                checked = self.pool.map(_verify_triple, pending)
+            else:
+                checked = [_verify_triple(triple) for triple in pending]
+            for (triple, indices), result in zip(pending.items(), checked):
+                self._put_cached(triple[0], triple[1], triple[2], result)
+                for i in indices:
+                    results[i] = result
+        return results
+
+    def is_header_verified(self, header_hash, head_hash):
+        """Whether the header passed `verify_collation_header` on the main
+        chain head `head_hash`
+        """
+        key = (header_hash, head_hash)
+        if key not in self.verified_headers:
+            return False
+        self.verified_headers.move_to_end(key)
+        self.header_hits += 1
+        return True
+
+    def add_verified_header(self, header_hash, head_hash):
+        """Remember that the header passed `verify_collation_header` on the
+        main chain head `head_hash`
+        """
+        self.verified_headers[(header_hash, head_hash)] = True
+        self.verified_headers.move_to_end((header_hash, head_hash))
+        while len(self.verified_headers) > self.cache_size:
+            self.verified_headers.popitem(last=False)
+
+    def close(self):
+        """Stop the worker processes created by this verifier
+        """
+        if self._owns_pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self._owns_pool = False
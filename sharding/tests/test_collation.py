@@ -1,7 +1,26 @@
+import gc
+
+import pytest
+import rlp
+from rlp.sedes import CountableList
+
+from ethereum import utils
+from ethereum.transactions import Transaction
 from ethereum.utils import encode_hex
+from sharding import collation as collation_module
 from sharding.collation import (
     CollationHeader,
     Collation,
+    is_legacy_collation_rlp,
+    encode_headers,
+    decode_headers,
+    encode_collations,
+    decode_collations,
+    pack_header,
+    unpack_header,
+    packed_header,
+    intern_header,
+    intern_collation,
 )
 
 
@@ -17,3 +36,227 @@ def test_collation_init():
 
     assert collation.transaction_count == 0
     assert collation_header_dict['coinbase'] == encode_hex(coinbase)
+
+
+def test_collation_header_hash_cache():
+    """Test that the header hashes are memoized and dropped on assignment
+    """
+    header = CollationHeader(coinbase='\x35' * 20)
+    CollationHeader.reset_hash_cache_info()
+
+    h1 = header.hash
+    assert header.hash == h1
+    assert header.hex_hash == encode_hex(h1)
+    info = CollationHeader.hash_cache_info()
+    assert info.hash_misses == 1
+    assert info.hash_hits == 2
+
+    signing_hash = header.signing_hash
+    assert header.signing_hash == signing_hash
+    info = CollationHeader.hash_cache_info()
+    assert info.signing_hash_misses == 1
+    assert info.signing_hash_hits == 1
+
+    # Assigning a field invalidates both hashes
+    header.number = 5
+    assert header.hash != h1
+    assert header.hash == utils.sha3(rlp.encode(CollationHeader(coinbase='\x35' * 20, number=5)))
+    assert header.signing_hash != signing_hash
+
+    # `sig` is not part of the signing hash
+    signing_hash = header.signing_hash
+    header.sig = b'\x01' * 96
+    assert header.signing_hash == signing_hash
+    assert header.hash != h1
+
+
+def test_decoded_collation_header_hash():
+    """Test the hash of a decoded header
+    """
+    header = CollationHeader(coinbase='\x35' * 20, number=3)
+    decoded = rlp.decode(rlp.encode(header), CollationHeader)
+    assert decoded.hash == header.hash
+    assert decoded == header
+
+
+def test_collation_header_attributes():
+    """Test that Collation exposes the attributes of its header
+    """
+    header = CollationHeader(coinbase='\x35' * 20, number=2)
+    collation = Collation(header)
+
+    assert collation.number == 2
+    assert collation.coinbase == header.coinbase
+    assert collation.hash == header.hash
+    assert collation.signing_hash == header.signing_hash
+    assert collation.to_dict() == header.to_dict()
+
+    # The delegation follows header mutations and header replacement
+    collation.header.number = 3
+    assert collation.number == 3
+    collation.header = CollationHeader(number=4)
+    assert collation.number == 4
+
+    # Attributes set on the header outside of its fields are reachable too
+    collation.header.prev_state_root = b'\x01' * 32
+    assert collation.prev_state_root == b'\x01' * 32
+
+    with pytest.raises(AttributeError):
+        collation.no_such_attribute
+    with pytest.raises(AttributeError):
+        header.no_such_attribute
+
+
+def test_lazy_collation_decoding():
+    """Test that decoded collations deserialize their transactions on demand
+    """
+    txs = [Transaction(i, 1, 21000, b'\x22' * 20, 5, b'').sign(b'\x11' * 32) for i in range(3)]
+    decoders = (lambda data: rlp.decode(data, Collation), Collation.lazy_decode)
+
+    for number, decode in enumerate(decoders):
+        # A distinct collation for each decoder, since decoded collations are
+        # interned
+        collation = Collation(CollationHeader(coinbase='\x35' * 20, number=number), txs)
+        collation_rlp = rlp.encode(collation)
+        decoded = decode(collation_rlp)
+        assert decoded._transactions is None
+        assert decoded.hash == collation.hash
+        assert decoded.transaction_count == 3
+        assert rlp.encode(decoded) == collation_rlp
+        # Still not deserialized
+        assert decoded._transactions is None
+
+        assert [tx.hash for tx in decoded.transactions] == [tx.hash for tx in txs]
+        assert decoded.transaction_count == 3
+        assert not decoded.is_mutable()
+        with pytest.raises(ValueError):
+            decoded.transactions = []
+
+    empty = Collation.lazy_decode(rlp.encode(Collation(CollationHeader())))
+    assert empty.transaction_count == 0
+    assert len(empty.transactions) == 0
+
+    with pytest.raises(rlp.DecodingError):
+        Collation.lazy_decode(collation_rlp + b'\x00')
+
+
+def test_collation_header_and_body_rlp():
+    """Test splitting a collation into header and transaction list RLP
+    """
+    txs = [Transaction(i, 1, 21000, b'\x22' * 20, 5, b'').sign(b'\x11' * 32) for i in range(2)]
+    collation = Collation(CollationHeader(coinbase='\x35' * 20, number=1), txs)
+    collation_rlp = rlp.encode(collation)
+    header_rlp = rlp.encode(collation.header)
+
+    assert is_legacy_collation_rlp(collation_rlp)
+    assert not is_legacy_collation_rlp(header_rlp)
+
+    decoded = Collation.lazy_decode(collation_rlp)
+    assert decoded.transactions_rlp == collation.transactions_rlp
+    assert decoded._transactions is None
+
+    rebuilt = Collation.from_serialized_transactions(rlp.decode(header_rlp, CollationHeader), decoded.transactions_rlp)
+    assert rlp.encode(rebuilt) == collation_rlp
+
+
+def test_batch_codec():
+    """Test encoding and decoding lists of headers and collations in one pass
+    """
+    headers = [CollationHeader(coinbase='\x35' * 20, number=i, sig=b'\x01' * i) for i in range(5)]
+    headers_rlp = encode_headers(headers)
+    assert headers_rlp == rlp.encode(headers, CountableList(CollationHeader))
+    assert encode_headers([]) == rlp.encode([])
+
+    for data in (headers_rlp, bytearray(headers_rlp), memoryview(headers_rlp)):
+        decoded = decode_headers(data)
+        assert decoded == headers
+        assert not any(header.is_mutable() for header in decoded)
+        assert encode_headers(decoded) == headers_rlp
+
+    # The cached RLP is dropped when a header changes
+    headers[0].number = 10
+    assert encode_headers(headers) == rlp.encode(headers, CountableList(CollationHeader))
+
+    txs = [Transaction(i, 1, 21000, b'\x22' * 20, 5, b'').sign(b'\x11' * 32) for i in range(3)]
+    collations = [Collation(header, txs[:i]) for i, header in enumerate(headers[:4])]
+    collations_rlp = encode_collations(collations)
+    assert collations_rlp == rlp.encode(collations, CountableList(Collation))
+
+    decoded = decode_collations(memoryview(collations_rlp))
+    assert [c.hash for c in decoded] == [c.hash for c in collations]
+    assert decoded[3]._transactions is None
+    assert encode_collations(decoded) == collations_rlp
+    assert [tx.hash for tx in decoded[3].transactions] == [tx.hash for tx in txs]
+    with pytest.raises(ValueError):
+        decoded[0].transactions = []
+
+    for bad in (headers_rlp + b'\x00', headers_rlp[:-1], rlp.encode([[b'']]), collations_rlp):
+        with pytest.raises(rlp.RLPException):
+            decode_headers(bad)
+
+
+def test_packed_header():
+    """Test the fixed-layout binary header format
+    """
+    header = CollationHeader(coinbase='\x35' * 20, number=2**64 - 1, sig=b'\x01' * 65)
+    packed = pack_header(header)
+    assert len(packed) == 207 + 65
+
+    for data in (packed, bytearray(packed), memoryview(packed)):
+        unpacked = unpack_header(data)
+        assert unpacked == header
+        assert rlp.encode(unpacked) == rlp.encode(header)
+        assert not unpacked.is_mutable()
+    assert unpack_header(packed, header_hash=b'\x02' * 32).hash == b'\x02' * 32
+    assert unpack_header(pack_header(CollationHeader())) == CollationHeader()
+
+    with pytest.raises(ValueError):
+        pack_header(CollationHeader(number=2**64))
+    with pytest.raises(ValueError):
+        unpack_header(packed[:-1])
+    with pytest.raises(ValueError):
+        unpack_header(b'\x02' + packed[1:])
+
+    # As a sedes in RLP messages
+    headers_rlp = rlp.encode([header, CollationHeader()], CountableList(packed_header))
+    assert rlp.decode(headers_rlp, CountableList(packed_header)) == (header, CollationHeader())
+    header.tx_list_root = b'\x01' * 31
+    with pytest.raises(rlp.SerializationError):
+        rlp.encode([header], CountableList(packed_header))
+
+
+def test_interning():
+    """Test that decoding the same header or collation again returns the
+    instance already in memory
+    """
+    txs = [Transaction(i, 1, 21000, b'\x22' * 20, 5, b'').sign(b'\x11' * 32) for i in range(2)]
+    header = CollationHeader(coinbase='\x35' * 20, number=11)
+    collation = Collation(header, txs)
+    header_rlp = rlp.encode(header)
+    collation_rlp = rlp.encode(collation)
+
+    decoded_header = rlp.decode(header_rlp, CollationHeader)
+    assert rlp.decode(header_rlp, CollationHeader) is decoded_header
+    assert decode_headers(rlp.encode([decoded_header]))[0] is decoded_header
+    assert unpack_header(pack_header(header), header.hash) is decoded_header
+    assert intern_header(header) is header
+    assert CollationHeader.deserialize(rlp.decode(header_rlp), mutable=True) is not decoded_header
+
+    decoded = Collation.lazy_decode(collation_rlp)
+    assert decoded.header is decoded_header
+    assert rlp.decode(collation_rlp, Collation) is decoded
+    assert decode_collations(rlp.encode([decoded]))[0] is decoded
+    assert intern_collation(collation) is collation
+
+    # Same header, different transactions
+    other = Collation.lazy_decode(rlp.encode(Collation(header, txs[:1])))
+    assert other is not decoded
+    assert other.transaction_count == 1
+
+    # Entries go away with the last reference
+    collation_hash = decoded.hash
+    del decoded, other, decoded_header
+    gc.collect()
+    assert collation_hash not in collation_module._interned_collations
+    assert collation_hash not in collation_module._interned_headers
+    assert rlp.decode(collation_rlp, Collation).hash == collation_hash
@@ -11,6 +11,7 @@ from ethereum.state import State
 from sharding import collator
 from sharding.collation import Collation, CollationHeader
 from sharding.tools import tester
+from sharding.sig_verifier import SignatureVerifier
 from sharding.config import sharding_config
 
 log = get_logger('test.collator')
@@ -215,6 +216,86 @@ def test_verify_collation_header():
     with pytest.raises(ValueError):
         collator.verify_collation_header(t.chain, collation.header)
 
+    # Bad collation header 3 - rejected by the local signature check
+    sig_verifier = SignatureVerifier()
+    collation = collator.create_collation(
+        t.chain,
+        shard_id,
+        parent_collation_hash,
+        expected_period_number,
+        coinbase=tester.a0,
+        key=tester.k0,
+        txqueue=txqueue)
+    assert collator.verify_collation_header(t.chain, collation.header, sig_verifier=sig_verifier)
+    collation.header.coinbase = tester.a1
+    with pytest.raises(ValueError):
+        collator.verify_collation_header(t.chain, collation.header, sig_verifier=sig_verifier)
+
+    # Signed by the sampled collator for another coinbase, which the
+    # contract accepts
+    collation = collator.create_collation(
+        t.chain,
+        shard_id,
+        parent_collation_hash,
+        expected_period_number,
+        coinbase=tester.a1,
+        key=tester.k0,
+        txqueue=txqueue)
+    assert collator.verify_collation_header(t.chain, collation.header)
+    assert collator.verify_collation_header(t.chain, collation.header, sig_verifier=sig_verifier)
+
+    # Bad collation header 4 - signed by a key other than the one of the
+    # sampled collator
+    collation = collator.create_collation(
+        t.chain,
+        shard_id,
+        parent_collation_hash,
+        expected_period_number,
+        coinbase=tester.a1,
+        key=tester.k1,
+        txqueue=txqueue)
+    with pytest.raises(ValueError):
+        collator.verify_collation_header(t.chain, collation.header, sig_verifier=sig_verifier)
+
+
+def test_get_collator_signer():
+    shard_id = 1
+    t = chain(shard_id)
+    state = collator.mk_add_header_state(t.chain)
+    assert collator.get_collator_signer(state, shard_id) == tester.a0
+
+    header = CollationHeader(sig=b'\x01' * 97)
+    assert collator.get_collator_sig(header) == b'\x01' * 96
+    header.sig = b'\x01' * 95
+    assert collator.get_collator_sig(header) == b'\x01' * 95 + b'\x00'
+
+
+def test_verify_collation_header_cache(monkeypatch):
+    """Test that a header verified with a SignatureVerifier is not checked
+    by the contract again until the main chain head changes
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    collation = t.generate_collation(shard_id=shard_id, coinbase=tester.a0, key=tester.k0, txqueue=None)
+    sig_verifier = SignatureVerifier()
+
+    calls = []
+    call_valmgr = collator.call_valmgr
+
+    def counting_call_valmgr(state, func, args, **kwargs):
+        calls.append(func)
+        return call_valmgr(state, func, args, **kwargs)
+    monkeypatch.setattr(collator, 'call_valmgr', counting_call_valmgr)
+
+    assert collator.verify_collation_header(t.chain, collation.header, sig_verifier=sig_verifier)
+    assert calls.count('add_header') == 1
+    assert collator.verify_collation_header(t.chain, collation.header, sig_verifier=sig_verifier)
+    assert calls.count('add_header') == 1
+    assert sig_verifier.header_hits == 1
+
+    t.mine(1)
+    assert not sig_verifier.is_header_verified(collation.header.hash, t.chain.head_hash)
+
 
 def test_get_deep_collation_hash_and_mk_fast_sync_state():
     shard_id = 1
@@ -0,0 +1,50 @@
+import os
+
+from ethereum.db import EphemDB
+
+from sharding.db import SQLiteDB, split_key, db_size, drop_db
+
+
+def test_split_key():
+    assert split_key(b'score:' + b'\x01' * 32) == (b'score:', b'\x01' * 32)
+    assert split_key(b'SHARD_12_GENESIS_STATE') == (b'SHARD_12_', b'GENESIS_STATE')
+    assert split_key(b'\x02' * 32) == (b'', b'\x02' * 32)
+
+
+def test_sqlite_db(tmpdir):
+    path = str(tmpdir.join('chain.db'))
+    db = SQLiteDB(path)
+    db.put(b'score:\x01', b'1')
+    db.put(b'score:\x02', b'2')
+    db.put(b'deletes:\x01', b'\x03' * 64)
+    db.put(b'\x04' * 32, b'node')
+    db.put(b'score:\x03', '3')
+    assert db.get(b'score:\x01') == b'1'
+    assert db.get(b'score:\x03') == b'3'
+    db.delete(b'score:\x02')
+    assert b'score:\x02' not in db
+    db.commit()
+    db.close()
+
+    db = SQLiteDB(path)
+    assert db.get(b'score:\x01') == b'1'
+    assert b'score:\x02' not in db
+    assert db.get(b'\x04' * 32) == b'node'
+    assert list(db.iter_prefix(b'score:')) == [(b'score:\x01', b'1'), (b'score:\x03', b'3')]
+    assert db.prefix_size(b'deletes:') == (1, len(b'deletes:\x01') + 64)
+
+    db.put(b'deletes:\x02', b'')
+    assert db.delete_prefix(b'deletes:') == 2
+    assert b'deletes:\x01' not in db
+    assert db.get(b'score:\x01') == b'1'
+
+
+def test_db_size_and_drop(tmpdir):
+    path = str(tmpdir.join('shard.db'))
+    for db in (EphemDB(), SQLiteDB(path)):
+        db.put(b'score:\x01', b'1')
+        db.put(b'\x02' * 32, b'node')
+        db.commit()
+        assert db_size(db) == len(b'score:\x01') + 1 + 32 + 4
+        drop_db(db)
+    assert not os.path.exists(path)
@@ -0,0 +1,64 @@
+import csv
+import io
+import json
+
+import pytest
+import rlp
+from ethereum.transactions import Transaction
+from ethereum.utils import encode_hex
+
+from sharding.collation import (
+    CollationHeader,
+    Collation,
+)
+from sharding.export import (
+    HEADER_COLUMNS,
+    COLLATION_COLUMNS,
+    export_headers,
+    export_collations,
+)
+
+
+def test_export_headers():
+    """Test exporting headers as NDJSON and CSV
+    """
+    headers = [CollationHeader(coinbase='\x35' * 20, number=i, sig=b'\x01' * i) for i in range(5)]
+
+    f = io.StringIO()
+    assert export_headers(iter(headers), f, chunk_size=2) == 5
+    rows = [json.loads(line) for line in f.getvalue().splitlines()]
+    assert len(rows) == 5
+    for row, header in zip(rows, headers):
+        assert sorted(row) == sorted(HEADER_COLUMNS)
+        assert row['hash'] == encode_hex(header.hash)
+        assert row['number'] == str(header.number)
+        assert row['coinbase'] == encode_hex(header.coinbase)
+        assert row['sig'] == encode_hex(header.sig)
+
+    f = io.StringIO()
+    assert export_headers(headers, f, fmt='csv') == 5
+    rows = list(csv.DictReader(io.StringIO(f.getvalue())))
+    assert [row['hash'] for row in rows] == [encode_hex(header.hash) for header in headers]
+    assert rows[4]['number'] == '4'
+
+    f = io.StringIO()
+    assert export_headers([], f) == 0
+    assert f.getvalue() == ''
+    with pytest.raises(ValueError):
+        export_headers(headers, f, fmt='xml')
+
+
+def test_export_collations():
+    """Test exporting collations without deserializing their transactions
+    """
+    txs = [Transaction(i, 1, 21000, b'\x22' * 20, 5, b'').sign(b'\x11' * 32) for i in range(3)]
+    collation = Collation(CollationHeader(coinbase='\x35' * 20, number=7), txs)
+    decoded = Collation.lazy_decode(rlp.encode(collation))
+
+    f = io.StringIO()
+    assert export_collations([decoded], f, fmt='csv') == 1
+    assert decoded._transactions is None
+    rows = list(csv.DictReader(io.StringIO(f.getvalue())))
+    assert sorted(rows[0]) == sorted(COLLATION_COLUMNS)
+    assert rows[0]['hash'] == encode_hex(collation.hash)
+    assert rows[0]['transaction_count'] == '3'
@@ -0,0 +1,72 @@
+import pytest
+
+from sharding.collation import CollationHeader
+
+np = pytest.importorskip('numpy')
+
+from sharding.header_store import HeaderStore  # noqa: E402
+
+
+def mk_header(number, period, parent=None):
+    header = CollationHeader(coinbase='\x35' * 20, number=number, expected_period_number=period)
+    if parent is not None:
+        header.parent_collation_hash = parent.hash
+    return header
+
+
+def test_header_store():
+    """Test adding headers and growing the columns
+    """
+    store = HeaderStore(capacity=2)
+    headers = [mk_header(1, 5)]
+    for i in range(1, 5):
+        headers.append(mk_header(i + 1, 5 + i, headers[-1]))
+    for header in headers:
+        store.add(header, header.number)
+    assert store.add(headers[0], 1) == 0
+
+    assert len(store) == 5
+    assert headers[4].hash in store
+    assert list(store.column('numbers')) == [1, 2, 3, 4, 5]
+    assert list(store.column('parents')) == [-1, 0, 1, 2, 3]
+    assert store.get_hashes([0, 4]) == [headers[0].hash, headers[4].hash]
+    with pytest.raises(ValueError):
+        store.column('numbers')[0] = 0
+
+
+def test_header_store_hash_with_trailing_zero():
+    """Test that hashes ending in a zero byte are kept whole
+    """
+    store = HeaderStore()
+    header = CollationHeader(number=43)
+    assert header.hash.endswith(b'\x00')
+    store.add(header, 1)
+    assert store.get_hashes([0]) == [header.hash]
+
+
+def test_header_store_queries():
+    """Test the period range and fork choice queries
+    """
+    store = HeaderStore()
+    assert store.best_row() == -1
+    periods, scores = store.max_score_per_period()
+    assert len(periods) == 0 and len(scores) == 0
+
+    a1 = mk_header(1, 5)
+    a2 = mk_header(2, 6, a1)
+    b2 = mk_header(2, 7, a1)
+    b3 = mk_header(3, 7, b2)
+    for header in (a1, a2, b2, b3):
+        store.add(header, header.number)
+
+    rows = store.rows_in_period_range(6, 8)
+    assert store.get_hashes(rows) == [a2.hash, b2.hash, b3.hash]
+    assert len(store.rows_in_period_range(8, 10)) == 0
+
+    periods, scores = store.max_score_per_period()
+    assert list(periods) == [5, 6, 7]
+    assert list(scores) == [1, 2, 3]
+
+    assert store.best_row() == store.row_of_hash[b3.hash]
+    assert store.best_row(store.rows_in_period_range(6, 7)) == store.row_of_hash[a2.hash]
+    assert store.best_row(store.rows_in_period_range(8, 10)) == -1
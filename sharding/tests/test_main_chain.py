@@ -1,13 +1,16 @@
 import pytest
 import logging
+import rlp
+from multiprocessing.pool import ThreadPool
 
 from ethereum.slogging import get_logger
 from ethereum.utils import encode_hex
 
 from sharding.tools import tester
 from sharding.shard_chain import ShardChain
-from sharding.collation import Collation
+from sharding.collation import Collation, CollationHeader
 from sharding.config import sharding_config
+from sharding.db import SQLiteDB
 
 log = get_logger('test.shard_chain')
 log.setLevel(logging.DEBUG)
@@ -43,6 +46,38 @@ def test_init_shard():
     assert len(t.chain.shard_id_list) == 2
 
 
+def test_drop_shard():
+    """Test that shards have their own db, which drop_shard drops
+    """
+    t = tester.Chain(env='sharding')
+    assert t.chain.init_shard(1)
+    assert t.chain.init_shard(2)
+    shard1 = t.chain.shards[1]
+    assert shard1.db is not t.chain.db
+    assert shard1.db is not t.chain.shards[2].db
+    assert shard1.db_size() > 0
+
+    assert t.chain.drop_shard(1)
+    assert not t.chain.has_shard(1)
+    assert shard1.db_size() == 0
+    assert not t.chain.drop_shard(1)
+    assert t.chain.has_shard(2)
+
+
+def test_shard_db_factory(tmpdir):
+    """Test that the shards of a chain get their db from shard_db_factory
+    """
+    def shard_db_factory(shard_id):
+        return SQLiteDB(str(tmpdir.join('shard_{}.db'.format(shard_id))))
+    t = tester.Chain(env='sharding', shard_db_factory=shard_db_factory)
+    assert t.chain.init_shard(1)
+    shard = t.chain.shards[1]
+    assert isinstance(shard.db, SQLiteDB)
+    assert shard.db.path == str(tmpdir.join('shard_1.db'))
+    assert shard.db_size() > 0
+    assert t.chain.drop_shard(1)
+
+
 def test_add_shard():
     """Test add_shard(self, shard)
     """
@@ -116,6 +151,103 @@ def test_handle_ignored_collation():
     assert t2.chain.shards[shard_id].get_score(collation3) == 3
 
 
+def test_update_head_collation_of_block():
+    """Test that a collation becomes the head collation of the blocks that
+    include it and of their descendants
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    shard = t.chain.shards[shard_id]
+
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    shard.add_collation(collation, period_start_prevblock)
+
+    blocks = [t.mine(1) for _ in range(3)]
+    shard.collation_blockhash_lists[collation.header.hash] = blocks[0].hash
+    assert t.chain.update_head_collation_of_block(collation)
+    for block in blocks:
+        assert shard.head_collation_of_block[block.hash] == collation.header.hash
+    assert shard.collation_blockhash_lists[collation.header.hash] == b''
+
+
+def test_parse_add_header_logs():
+    """Test routing add_header logs to the watched shards
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    shard = t.chain.shards[shard_id]
+    shard.active = True
+
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    shard.add_collation(collation, period_start_prevblock)
+    missing_header = CollationHeader(shard_id=shard_id, number=2)
+    other_header = CollationHeader(shard_id=2)
+
+    block = t.mine(1)
+    t.chain.add_header_logs = [rlp.encode(h) for h in (collation.header, missing_header, other_header)]
+    collation_map, missing_collations_map = t.chain.parse_add_header_logs(block)
+    assert collation_map[shard_id].header.hash == collation.header.hash
+    assert missing_collations_map == {shard_id: {missing_header.hash: block}}
+    assert t.chain.add_header_logs == []
+    assert t.chain.add_header_logs_seen == 3
+    assert t.chain.add_header_logs_watched == 2
+
+
+def test_reorganize_shards():
+    """Test reorganizing the heads of all shards on a thread pool
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    t.add_test_shard(2)
+    pool = ThreadPool(2)
+    t.chain.reorg_pool = pool
+    genesis_prevhash = t.chain.shards[2].env.config['GENESIS_PREVHASH']
+
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    t.chain.shards[shard_id].add_collation(collation, period_start_prevblock)
+    block = t.mine(1)
+    t.chain.reorganize_shards(block, {shard_id: collation})
+    pool.close()
+
+    assert t.chain.shards[shard_id].head_hash == collation.header.hash
+    assert t.chain.shards[shard_id].head_collation_of_block[block.hash] == collation.header.hash
+    assert t.chain.shards[shard_id].collation_blockhash_lists.get_hashes(collation.header.hash) == [block.hash]
+    assert t.chain.shards[2].head_hash == genesis_prevhash
+    assert t.chain.shards[2].head_collation_of_block[block.hash] == genesis_prevhash
+
+
+def test_import_blocks():
+    """Test importing a run of blocks with a commit per chunk
+    """
+    source = tester.Chain(env='sharding')
+    source.mine(5)
+    blocks = [source.chain.get_block_by_number(i) for i in range(1, 6)]
+
+    target = tester.Chain(env='sharding').chain
+    commits = []
+    db_commit = target.db.commit
+
+    def commit():
+        commits.append(True)
+        db_commit()
+    target.db.commit = commit
+    added = []
+
+    def callback(block, success, missing_collations):
+        added.append((block.hash, success))
+    # Stop before a block that doesn't extend the run
+    assert target.import_blocks([blocks[0], blocks[2]], callback=callback) == (1, {})
+    assert added == [(blocks[0].hash, True)]
+    assert len(commits) == 1
+
+    assert target.import_blocks(blocks[1:], chunk_size=2) == (4, {})
+    assert target.head_hash == blocks[-1].hash
+    assert len(commits) == 3
+
+
 def test_longest_chain_rule():
     # Initial chains
     shard_id = 1
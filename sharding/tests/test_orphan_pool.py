@@ -0,0 +1,51 @@
+from sharding.collation import Collation, CollationHeader
+from sharding.orphan_pool import OrphanPool
+
+
+def mk_collation(parent_collation_hash, number, period=0):
+    return Collation(CollationHeader(
+        parent_collation_hash=parent_collation_hash,
+        number=number,
+        expected_period_number=period,
+    ))
+
+
+def test_pop_children():
+    pool = OrphanPool()
+    collation1 = mk_collation(b'\x01' * 32, 1)
+    collation2 = mk_collation(collation1.header.hash, 2)
+    sibling = mk_collation(b'\x01' * 32, 2)
+
+    assert pool.add(collation1)
+    assert pool.add(collation2)
+    assert pool.add(sibling)
+    assert not pool.add(collation1)
+    assert len(pool) == 3
+    assert pool.stats()['duplicates'] == 1
+
+    assert pool.pop_children(b'\x01' * 32) == [collation1, sibling]
+    assert pool.pop_children(b'\x01' * 32) == []
+    assert pool.pop_children(collation1.header.hash) == [collation2]
+    assert len(pool) == 0
+    assert pool.size_bytes == 0
+    assert pool.stats()['resolved'] == 3
+
+
+def test_limits():
+    pool = OrphanPool(max_count=2, max_age_periods=5)
+    collations = [mk_collation(b'\x01' * 32, i + 1, period=i) for i in range(3)]
+    for collation in collations:
+        assert pool.add(collation)
+    # The oldest collation was evicted
+    assert collations[0].header.hash not in pool
+    assert pool.stats()['evicted'] == 1
+
+    # Period 10 expires the collations of periods before 5
+    assert pool.add(mk_collation(b'\x02' * 32, 1, period=10))
+    assert len(pool) == 1
+    assert pool.stats()['expired'] == 2
+    assert not pool.add(mk_collation(b'\x03' * 32, 1, period=4))
+
+    pool = OrphanPool(max_bytes=1)
+    assert not pool.add(collations[0])
+    assert len(pool) == 0
@@ -1,6 +1,9 @@
 import pytest
 import logging
 
+import rlp
+from rlp.sedes import CountableList
+
 from ethereum.utils import encode_hex
 from ethereum.slogging import get_logger
 from ethereum.transaction_queue import TransactionQueue
@@ -8,9 +11,11 @@ from ethereum import utils
 from ethereum import trie
 from ethereum.config import Env
 from ethereum.state import State
+from ethereum.transactions import Transaction
 
 from sharding.tools import tester
 from sharding.shard_chain import ShardChain
+from sharding.collation import pack_header
 from sharding.config import sharding_config
 
 log = get_logger('test.shard_chain')
@@ -81,6 +86,12 @@ def test_add_collation_error():
     # apply_collation error
     assert not t.chain.shards[shard_id].add_collation(collation2, period_start_prevblock)
 
+    # number doesn't match the score
+    collation3 = t.generate_collation(shard_id=1, coinbase=tester.a2, key=tester.k1, txqueue=None, parent_collation_hash=collation1.header.hash)
+    collation3.header.number = 3
+    assert not t.chain.shards[shard_id].add_collation(collation3, period_start_prevblock)
+    assert collation3.header.hash not in t.chain.shards[shard_id].db
+
 
 def test_handle_ignored_collation():
     """Test handle_ignored_collation(self, collation, period_start_prevblock)
@@ -164,6 +175,279 @@ def test_get_collation():
     assert t.chain.shards[shard_id].get_collation(collation.header.hash).header.hash == collation.header.hash
 
 
+def test_get_collation_header():
+    """Test get_collation_header(self, collation_hash)
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    shard = t.chain.shards[shard_id]
+
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    shard.add_collation(collation, period_start_prevblock)
+
+    # header and transaction list are stored under separate keys
+    assert shard.db.get(collation.header.hash) == rlp.encode(collation.header)
+    assert shard.db.get(b'collation_body:' + collation.header.hash) == rlp.encode(collation.transactions, CountableList(Transaction))
+    assert shard.get_collation_header(collation.header.hash) == collation.header
+    assert shard.get_collation_header(b'1234') is None
+    assert rlp.encode(shard.get_collation(collation.header.hash)) == rlp.encode(collation)
+
+
+def test_legacy_collation_storage():
+    """Test migrating collations stored as a whole under their hash
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    shard = t.chain.shards[shard_id]
+
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    shard.add_collation(collation, period_start_prevblock)
+    shard.db.put(collation.header.hash, rlp.encode(collation))
+    shard.db.delete(b'collation_body:' + collation.header.hash)
+
+    assert shard.get_collation_header(collation.header.hash) == collation.header
+    assert shard.db.get(collation.header.hash) == rlp.encode(collation.header)
+    assert rlp.encode(shard.get_collation(collation.header.hash)) == rlp.encode(collation)
+
+    shard.db.put(collation.header.hash, rlp.encode(collation))
+    shard.head_hash = collation.header.hash
+    shard.migrate_collation_storage()
+    assert shard.db.get(collation.header.hash) == rlp.encode(collation.header)
+
+
+def test_packed_header_storage():
+    """Test storing collation headers in the packed format
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    shard = t.chain.shards[shard_id]
+
+    collation1 = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation1.header.period_start_prevhash)
+    shard.add_collation(collation1, period_start_prevblock)
+
+    shard.packed_headers = True
+    collation2 = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None, parent_collation_hash=collation1.header.hash)
+    period_start_prevblock = t.chain.get_block(collation2.header.period_start_prevhash)
+    shard.add_collation(collation2, period_start_prevblock)
+
+    # Both formats are readable side by side
+    assert shard.db.get(collation1.header.hash) == rlp.encode(collation1.header)
+    assert shard.db.get(collation2.header.hash) == pack_header(collation2.header)
+    assert shard.get_collation_header(collation2.header.hash) == collation2.header
+    assert rlp.encode(shard.get_collation(collation2.header.hash)) == rlp.encode(collation2)
+    assert shard.get_score(collation2) == 2
+    assert list(shard.iter_headers(collation2.header.hash)) == [collation2.header, collation1.header]
+
+
+def test_header_store():
+    """Test that the columnar header store follows add_collation
+    """
+    pytest.importorskip('numpy')
+    from sharding.header_store import HeaderStore
+    shard_id = 1
+    t = chain(shard_id)
+    shard = t.chain.shards[shard_id]
+    # The store is off by default
+    assert shard.header_store is None
+    shard.header_store = HeaderStore()
+
+    collation1 = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation1.header.period_start_prevhash)
+    shard.add_collation(collation1, period_start_prevblock)
+    collation2 = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None, parent_collation_hash=collation1.header.hash)
+    period_start_prevblock = t.chain.get_block(collation2.header.period_start_prevhash)
+    shard.add_collation(collation2, period_start_prevblock)
+
+    store = shard.header_store
+    assert len(store) == 2
+    assert list(store.column('scores')) == [1, 2]
+    assert list(store.column('parents')) == [-1, 0]
+    assert store.get_hashes([store.best_row()]) == [collation2.header.hash]
+
+
+def test_repair_score_index():
+    """Test storing the missing scores of a legacy database
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    shard = t.chain.shards[shard_id]
+
+    collation1 = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation1.header.period_start_prevhash)
+    shard.add_collation(collation1, period_start_prevblock)
+    collation2 = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None, parent_collation_hash=collation1.header.hash)
+    period_start_prevblock = t.chain.get_block(collation2.header.period_start_prevhash)
+    shard.add_collation(collation2, period_start_prevblock)
+    assert shard.db.get(b'score:' + collation2.header.hash) == b'2'
+
+    shard.db.delete(b'score:' + collation1.header.hash)
+    shard.db.delete(b'score:' + collation2.header.hash)
+    shard.head_hash = collation2.header.hash
+    assert not shard.repair_score_index(budget=1)
+    assert b'score:' + collation2.header.hash not in shard.db
+    assert shard.repair_score_index(budget=2)
+    assert shard.db.get(b'score:' + collation1.header.hash) == b'1'
+    assert shard.db.get(b'score:' + collation2.header.hash) == b'2'
+    assert shard.get_score(collation2) == 2
+
+
+def test_ancestor_index():
+    """Test get_ancestor_hash and get_common_ancestor
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    shard = t.chain.shards[shard_id]
+    genesis_prevhash = shard.env.config['GENESIS_PREVHASH']
+
+    hashes = [genesis_prevhash]
+    for _ in range(3):
+        collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None, parent_collation_hash=hashes[-1])
+        period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+        shard.add_collation(collation, period_start_prevblock)
+        hashes.append(collation.header.hash)
+    # A fork from the first collation
+    fork = t.generate_collation(shard_id=1, coinbase=tester.a2, key=tester.k1, txqueue=None, parent_collation_hash=hashes[1])
+    period_start_prevblock = t.chain.get_block(fork.header.period_start_prevhash)
+    shard.add_collation(fork, period_start_prevblock)
+
+    for depth in range(4):
+        assert shard.get_ancestor_hash(hashes[3], depth) == hashes[3 - depth]
+    assert shard.get_ancestor_hash(hashes[3], 4) is None
+    assert shard.get_common_ancestor(hashes[3], fork.header.hash) == hashes[1]
+    assert shard.get_common_ancestor(hashes[2], hashes[3]) == hashes[2]
+
+    # Entries missing from an older database are rebuilt
+    shard.db.delete(b'skiplist:' + hashes[2])
+    shard.db.delete(b'skiplist:' + hashes[3])
+    assert shard.get_ancestor_hash(hashes[3], 3) == genesis_prevhash
+
+
+def test_poststate_cache():
+    """Test that cached post-states are returned as independent states
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    shard = t.chain.shards[shard_id]
+
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    shard.add_collation(collation, period_start_prevblock)
+
+    state1 = shard.mk_poststate_of_collation_hash(collation.header.hash)
+    assert collation.header.hash in shard.state_cache
+    state1.set_balance(tester.a3, 12345)
+    state1.commit()
+    state2 = shard.mk_poststate_of_collation_hash(collation.header.hash)
+    assert state2.trie.root_hash == collation.header.post_state_root
+    assert state2.block_coinbase == collation.header.coinbase
+    assert state2.get_balance(tester.a3) != 12345
+
+    genesis_prevhash = shard.env.config['GENESIS_PREVHASH']
+    genesis_state = shard.mk_poststate_of_collation_hash(genesis_prevhash)
+    shard.state_cache.clear()
+    assert shard.mk_poststate_of_collation_hash(genesis_prevhash).trie.root_hash == genesis_state.trie.root_hash
+
+
+def test_prune():
+    """Test pruning the journals and trie nodes of old collations
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    shard = t.chain.shards[shard_id]
+    shard.max_history = None
+
+    hashes = []
+    for _ in range(3):
+        collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+        period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+        shard.add_collation(collation, period_start_prevblock)
+        shard.head_hash = collation.header.hash
+        hashes.append(collation.header.hash)
+    assert all(b'deletes:' + h in shard.db for h in hashes)
+
+    assert shard.prune(max_history=1) > 0
+    assert b'deletes:' + hashes[0] not in shard.db
+    assert b'deletes:' + hashes[1] not in shard.db
+    assert b'deletes:' + hashes[2] in shard.db
+    assert shard.prune(max_history=1) == 0
+    state = shard.mk_poststate_of_collation_hash(hashes[2])
+    assert state.get_balance(tester.a1) == 1000006000000000000000
+
+    # Pruned on insertion
+    shard.max_history = 1
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    shard.add_collation(collation, period_start_prevblock)
+    assert b'deletes:' + hashes[2] not in shard.db
+
+
+def test_write_batch():
+    """Test that a write batch commits once
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    shard = t.chain.shards[shard_id]
+
+    commits = []
+    db_commit = shard.db.commit
+
+    def commit():
+        commits.append(True)
+        db_commit()
+    shard.db.commit = commit
+
+    with shard.write_batch():
+        for _ in range(2):
+            collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+            period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+            assert shard.add_collation(collation, period_start_prevblock)
+            shard.head_hash = collation.header.hash
+        assert len(commits) == 0
+    assert len(commits) == 1
+    assert shard.get_score(collation) == 2
+
+
+def test_head():
+    """Test that the head collation is cached until the head hash changes
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    shard = t.chain.shards[shard_id]
+    assert shard.head.number == 0
+
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    shard.add_collation(collation, period_start_prevblock)
+    shard.head_hash = collation.header.hash
+    head = shard.head
+    assert head.header.hash == collation.header.hash
+    assert shard.head is head
+
+
+def test_lazy_state():
+    """Test that the state is made when it is read after the head changes
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    shard = t.chain.shards[shard_id]
+    state = shard.state
+
+    collation = t.generate_collation(shard_id=1, coinbase=tester.a1, key=tester.k1, txqueue=None)
+    period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+    shard.add_collation(collation, period_start_prevblock)
+    # Setting the same head keeps the state
+    shard.head_hash = shard.head_hash
+    assert shard.state is state
+
+    shard.head_hash = collation.header.hash
+    assert shard._state is None
+    assert shard.state.trie.root_hash == collation.header.post_state_root
+    assert shard.state is shard.state
+
+
 def test_get_parent():
     """Test get_parent(self, collation)
     """
@@ -216,6 +500,36 @@ def test_set_state():
     )
 
 
+def test_prune_after_set_head():
+    """Test pruning the collations added after set_head, whose ancestors are
+    not stored
+    """
+    shard_id = 1
+    t = chain(shard_id)
+    t.collate(shard_id, tester.k0)
+    t.mine(5)
+    shard = t.chain.shards[shard_id]
+
+    other_shard = ShardChain(shard_id, env=Env(config=sharding_config), main_chain=t.chain, max_history=1)
+    state = State.from_snapshot(shard.state.to_snapshot(), other_shard.env, executing_on_head=True)
+    assert other_shard.set_head(state, shard.head)
+    assert other_shard.get_ancestor_hash(shard.head.hash, 1) == shard.head.header.parent_collation_hash
+
+    hashes = []
+    parent_collation_hash = shard.head.hash
+    for _ in range(2):
+        collation = t.generate_collation(
+            shard_id=shard_id, coinbase=tester.a1, key=tester.k1, txqueue=None,
+            parent_collation_hash=parent_collation_hash)
+        period_start_prevblock = t.chain.get_block(collation.header.period_start_prevhash)
+        assert other_shard.add_collation(collation, period_start_prevblock)
+        parent_collation_hash = collation.header.hash
+        hashes.append(collation.header.hash)
+    assert other_shard.get_ancestor_hash(hashes[1], 2) == shard.head.hash
+    assert b'deletes:' + hashes[0] not in other_shard.db
+    assert b'deletes:' + hashes[1] in other_shard.db
+
+
 def test_cb_function():
     shard_id = 1
     t = tester.Chain(env='sharding', deploy_sharding_contracts=True)
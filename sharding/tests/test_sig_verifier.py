@@ -0,0 +1,92 @@
+from ethereum import utils
+
+from sharding.collation import CollationHeader
+from sharding.contract_utils import sign
+from sharding.sig_verifier import (
+    SignatureVerifier,
+    verify_signature,
+)
+
+privkey = utils.sha3(b'collator')
+address = utils.privtoaddr(privkey)
+
+
+def mk_signed_header(number):
+    header = CollationHeader(coinbase=address, number=number)
+    header.sig = sign(header.signing_hash, privkey)
+    return header
+
+
+def test_verify_signature():
+    """Test checking a header signature against the signer address
+    """
+    header = mk_signed_header(1)
+    assert verify_signature(header.signing_hash, header.sig, address)
+    assert not verify_signature(header.signing_hash, header.sig, b'\x01' * 20)
+    assert not verify_signature(utils.sha3(b'other'), header.sig, address)
+    assert not verify_signature(header.signing_hash, header.sig[:-1], address)
+    assert not verify_signature(header.signing_hash, b'\x00' * 96, address)
+    assert not verify_signature(header.signing_hash, b'', address)
+
+
+def test_signature_verifier_cache():
+    """Test that verified triples are cached by signing hash
+    """
+    verifier = SignatureVerifier(cache_size=2)
+    header1, header2, header3 = [mk_signed_header(i) for i in range(3)]
+
+    assert verifier.verify(header1.signing_hash, header1.sig, address)
+    assert verifier.verify(header1.signing_hash, header1.sig, address)
+    assert (verifier.hits, verifier.misses) == (1, 1)
+
+    # A different signature or signer for a cached signing hash is checked,
+    # without evicting the valid one
+    assert not verifier.verify(header1.signing_hash, header2.sig, address)
+    assert not verifier.verify(header1.signing_hash, header1.sig, b'\x01' * 20)
+    assert verifier.misses == 3
+    assert verifier.verify(header1.signing_hash, header1.sig, address)
+    assert verifier.hits == 2
+
+    # Least recently used results are evicted
+    verifier.verify(header2.signing_hash, header2.sig, address)
+    verifier.verify(header3.signing_hash, header3.sig, address)
+    assert list(verifier.cache) == [header2.signing_hash, header3.signing_hash]
+
+
+def test_signature_verifier_verified_headers():
+    """Test remembering the headers verified on a main chain head
+    """
+    verifier = SignatureVerifier(cache_size=2)
+    header1, header2, header3 = [mk_signed_header(i) for i in range(3)]
+    head1, head2 = b'\x01' * 32, b'\x02' * 32
+
+    assert not verifier.is_header_verified(header1.hash, head1)
+    verifier.add_verified_header(header1.hash, head1)
+    assert verifier.is_header_verified(header1.hash, head1)
+    assert not verifier.is_header_verified(header1.hash, head2)
+    assert verifier.header_hits == 1
+
+    # Least recently used headers are evicted
+    verifier.add_verified_header(header2.hash, head1)
+    assert verifier.is_header_verified(header1.hash, head1)
+    verifier.add_verified_header(header3.hash, head1)
+    assert list(verifier.verified_headers) == [(header1.hash, head1), (header3.hash, head1)]
+
+
+def test_signature_verifier_batch():
+    """Test verifying a batch in worker processes
+    """
+    headers = [mk_signed_header(i) for i in range(4)]
+    triples = [(header.signing_hash, header.sig, address) for header in headers]
+    triples.append((headers[0].signing_hash, headers[1].sig, address))
+    triples.append(triples[1])
+
+    verifier = SignatureVerifier(processes=2)
+    try:
+        assert verifier.verify_many(triples) == [True] * 4 + [False, True]
+        assert verifier.misses == 5
+        assert verifier.verify_many(triples[:4]) == [True] * 4
+        assert verifier.hits == 4
+    finally:
+        verifier.close()
+    assert verifier.pool is None
@@ -20,6 +20,7 @@ from sharding.validator_manager_utils import (
     call_tx_to_shard,
     call_contract_constantly,
     get_shard_list,
+    get_valcode_signer,
     get_valmgr_addr,
     get_valmgr_ct
 )
@@ -162,6 +163,15 @@ def test_sign():
     assert sign(msg_hash2, privkey) == b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x1b\x10\xcf\xacjd\xa9@\xf44\xd5K[A\xbb\xde&0\xc3V\xe4\x9f\xe9+\xf6\'\x0eVbQtYf"5\x04\x85\xc8\x1dB\x92\xd9\xc9r\xed\x9a\x08\xfet\xce@\xa2\x1bm\x88\xc2\x875\xff\x99\xc5oN\xac\xa4'
 
 
+def test_get_valcode_signer(chain):
+    """Test get_valcode_signer(state, validation_code_addr)
+    """
+    k0_valcode_addr = chain.direct_tx(create_contract_tx(chain.head_state, t.k0, mk_validation_code(t.a0)))
+    assert get_valcode_signer(chain.head_state, k0_valcode_addr) == t.a0
+    assert get_valcode_signer(chain.head_state, get_valmgr_addr()) is None
+    assert get_valcode_signer(chain.head_state, t.a1) is None
+
+
 def test_get_validators_max_index(chain):
     k0_valcode = mk_validation_code(t.a0)
     k1_valcode = mk_validation_code(t.a1)
@@ -0,0 +1,46 @@
+from ethereum.db import EphemDB
+
+from sharding.windowed_index import WindowedIndex
+
+
+def test_window():
+    db = EphemDB()
+    index = WindowedIndex(db, b'test:', window=2)
+    index[b'\x01' * 32] = b'a'
+    index[b'\x02' * 32] = b'b'
+    index[b'\x01' * 32] = b'c'
+    assert index.items() == [(b'\x01' * 32, b'c'), (b'\x02' * 32, b'b')]
+
+    index[b'\x03' * 32] = b'd'
+    assert b'\x01' * 32 not in index
+    assert index.get(b'\x01' * 32) is None
+    assert index.keys() == [b'\x02' * 32, b'\x03' * 32]
+    assert len(index) == 2
+    # Only the latest keys are stored
+    assert len([key for key in db.kv if key.startswith(b'test:key:')]) == 2
+
+    # Reloaded from the db
+    index = WindowedIndex(db, b'test:', window=2)
+    assert index.values() == [b'b', b'd']
+
+
+def test_hashes():
+    index = WindowedIndex(EphemDB(), b'test:')
+    assert index.get_hashes(b'\x01' * 32) == []
+    index.append_hash(b'\x01' * 32, b'\x02' * 32)
+    index.append_hash(b'\x01' * 32, b'\x03' * 32)
+    assert index.get_hashes(b'\x01' * 32) == [b'\x02' * 32, b'\x03' * 32]
+
+
+def test_shared_db():
+    """Test indexes of different shards in one db, as ShardChain keeps them
+    """
+    db = EphemDB()
+    index1 = WindowedIndex(db, b'head_coll:1:', window=1)
+    index2 = WindowedIndex(db, b'head_coll:2:', window=1)
+    index1[b'\x01' * 32] = b'a'
+    index2[b'\x01' * 32] = b'b'
+    index2[b'\x02' * 32] = b'c'
+    assert index1.items() == [(b'\x01' * 32, b'a')]
+    assert index2.items() == [(b'\x02' * 32, b'c')]
+    assert WindowedIndex(db, b'head_coll:1:', window=1).count == 1
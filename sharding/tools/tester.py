@@ -1,6 +1,5 @@
 import types
 import rlp
-from rlp.sedes import List, binary
 
 from ethereum import utils
 from ethereum.utils import (
@@ -42,7 +41,6 @@ from sharding.contract_utils import (
     create_contract_tx,
 )
 from sharding.validator_manager_utils import (
-    ADD_HEADER_TOPIC,
     DEPOSIT_SIZE,
     WITHDRAW_HASH,
     mk_validation_code,
@@ -52,6 +50,8 @@ from sharding.validator_manager_utils import (
     call_deposit,
     call_withdraw,
     call_tx_add_header,
+    add_header_topic,
+    decode_add_header_logs,
 )
 from sharding import used_receipt_store_utils
 
@@ -196,7 +196,8 @@ def get_env(env):
 
 
 class Chain(object):
-    def __init__(self, alloc=None, env=None, deploy_sharding_contracts=False, genesis=None):
+    def __init__(self, alloc=None, env=None, deploy_sharding_contracts=False, genesis=None, reorg_pool=None,
+                 shard_db_factory=None):
         # MainChain
         if genesis is None:
             genesis = mk_basic_state(
@@ -205,7 +206,9 @@ class Chain(object):
                 get_env(env))
         self.chain = MainChain(
             genesis=genesis,
-            reset_genesis=True
+            reset_genesis=True,
+            reorg_pool=reorg_pool,
+            shard_db_factory=shard_db_factory
         )
         self.cs = get_consensus_strategy(self.chain.env.config)
         self.block = mk_block_from_prevstate(self.chain, timestamp=self.chain.state.timestamp + 1)
@@ -282,17 +285,14 @@ class Chain(object):
         b = self.block
 
         # Reorganize head collation
-        collation = None
+        collation_map = {}
         # Check add_header_logs
-        for item in self.add_header_logs:
-            # use sedes to prevent integer 0 from being decoded as b''
-            sedes = List([utils.big_endian_int, utils.big_endian_int, utils.hash32, utils.hash32, utils.hash32, utils.address, utils.hash32, utils.hash32, utils.big_endian_int, binary])
-            values = rlp.decode(item, sedes)
-            shard_id = values[0]
+        for shard_id, collation_hashes in decode_add_header_logs(self.add_header_logs).items():
             if shard_id in self.chain.shard_id_list:
-                collation_hash = sha3(item)
-                collation = self.chain.shards[shard_id].get_collation(collation_hash)
-        self.chain.reorganize_head_collation(b, collation)
+                collation = self.chain.shards[shard_id].get_collation(collation_hashes[-1])
+                if collation is not None:
+                    collation_map[shard_id] = collation
+        self.chain.reorganize_shards(b, collation_map)
         # Clear logs
         self.add_header_logs = []
 
@@ -300,7 +300,7 @@ class Chain(object):
             b, _ = make_head_candidate(self.chain, parent=b, timestamp=self.chain.state.timestamp + 14, coinbase=coinbase)
             b = Miner(b).mine(rounds=100, start_nonce=0)
             assert self.chain.add_block(b)
-            self.chain.reorganize_head_collation(b, None)
+            self.chain.reorganize_shards(b)
 
         self.change_head(b.header.hash, coinbase)
         return b
@@ -332,8 +332,6 @@ class Chain(object):
         self.shard_last_tx[shard_id] = None
 
         # Append log_listeners
-        add_header_topic = utils.big_endian_to_int(ADD_HEADER_TOPIC)
-
         def header_event_watcher(log):
             if log.topics[0] == add_header_topic:
                 self.add_header_logs.append(log.data)
@@ -378,7 +376,7 @@ class Chain(object):
         collation.header.expected_period_number = expected_period_number
         collation.header.period_start_prevhash = period_start_prevhash
         collation.header.parent_collation_hash = parent_collation_hash
-        collation.header.number = self.chain.shards[shard_id].get_collation(parent_collation_hash).number + 1
+        collation.header.number = self.chain.shards[shard_id].get_collation_header(parent_collation_hash).number + 1
         self.collation[shard_id] = collation
 
     def add_test_shard(self, shard_id, setup_urs_contracts=True, alloc=None):
@@ -388,7 +386,7 @@ class Chain(object):
 
         initial_state = mk_basic_state(
             base_alloc if alloc is None else alloc,
-            None, self.chain.env)
+            None, self.chain.mk_shard_env(shard_id))
         initial_state.delta_balance(
             used_receipt_store_utils.get_urs_contract(shard_id)['addr'],
             (10 ** 9) * utils.denoms.ether
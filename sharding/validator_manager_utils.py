@@ -1,5 +1,6 @@
 import os
 import rlp
+from rlp.sedes import List, binary
 from viper import compiler
 
 from ethereum import (
@@ -22,6 +23,13 @@ from sharding.contract_utils import (
 DEPOSIT_SIZE = sharding_config['DEPOSIT_SIZE']
 WITHDRAW_HASH = utils.sha3("withdraw")
 ADD_HEADER_TOPIC = utils.sha3("add_header()")
+add_header_topic = utils.big_endian_to_int(ADD_HEADER_TOPIC)
+# The data of an add_header log is the RLP of a collation header, see
+# `sharding.collation.CollationHeader`
+# use sedes to prevent integer 0 from being decoded as b''
+add_header_log_sedes = List([
+    utils.big_endian_int, utils.big_endian_int, utils.hash32, utils.hash32, utils.hash32,
+    utils.address, utils.hash32, utils.hash32, utils.big_endian_int, binary])
 
 _valmgr_ct = None
 _valmgr_code = None
@@ -41,6 +49,17 @@ class MessageFailed(Exception):
     pass
 
 
+def decode_add_header_logs(logs):
+    """Decode the data of the add_header logs of a block, returning the
+    hashes of the collation headers by shard id, in the order of the logs
+    """
+    headers = {}
+    for data in logs:
+        shard_id = rlp.decode(data, add_header_log_sedes)[0]
+        headers.setdefault(shard_id, []).append(utils.sha3(data))
+    return headers
+
+
 def mk_validation_code(address):
     '''
     validation_code = """
@@ -59,6 +78,23 @@ return(~mload(0) == {})
     return validation_code_bytecode
 
 
+def get_valcode_signer(state, validation_code_addr):
+    """Get the address whose signatures the validation code deployed at
+    `validation_code_addr` accepts, or None if it is not the code of
+    `mk_validation_code`
+    """
+    # The deployed code is what the first 14 bytes of the init code return,
+    # the number of bytes pushed by its first instruction
+    init_code = mk_validation_code(b'\xff' * 20)
+    template = init_code[14:14 + utils.big_endian_to_int(init_code[1:3])]
+    offset = template.index(b'\xff' * 20)
+    code = state.get_code(validation_code_addr)
+    address = code[offset:offset + 20]
+    if code != template[:offset] + address + template[offset + 20:]:
+        return None
+    return address
+
+
 def get_valmgr_ct():
     global _valmgr_ct, _valmgr_code
     if not _valmgr_ct:
@@ -0,0 +1,83 @@
+from ethereum.utils import to_string
+
+
+class WindowedIndex(object):
+    """A mapping of hashes to byte strings, stored in a db under `prefix` and
+    limited to the `window` latest keys
+
+    Keys take the slots of a ring in the order in which they are added, and
+    adding a key to a full ring deletes the oldest one, so the index takes
+    bounded space however long the chain grows, and it survives restarts
+    with a persistent db. Setting an existing key keeps its slot.
+
+    :param db: the db to store the index in
+    :param prefix: the prefix of the keys of this index in the db
+    :param window: the number of keys kept
+    """
+
+    def __init__(self, db, prefix, window=1000):
+        self.db = db
+        self.prefix = prefix
+        self.window = window
+        try:
+            self.count = int(self.db.get(prefix + b'count'))
+        except KeyError:
+            self.count = 0
+
+    def _key(self, key):
+        return self.prefix + b'key:' + key
+
+    def _slot(self, i):
+        return self.prefix + b'slot:' + to_string(i % self.window)
+
+    def __len__(self):
+        return min(self.count, self.window)
+
+    def __contains__(self, key):
+        return self._key(key) in self.db
+
+    def __getitem__(self, key):
+        return self.db.get(self._key(key))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            slot = self._slot(self.count)
+            if self.count >= self.window:
+                self.db.delete(self._key(self.db.get(slot)))
+            self.db.put(slot, key)
+            self.count += 1
+            self.db.put(self.prefix + b'count', to_string(self.count))
+        self.db.put(self._key(key), value)
+
+    def __iter__(self):
+        """Iterate over the keys, oldest first
+        """
+        for i in range(max(0, self.count - self.window), self.count):
+            yield self.db.get(self._slot(i))
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def get_hashes(self, key):
+        """Get the value of a key as a list of 32 byte hashes, empty if the
+        key is missing
+        """
+        value = self.get(key, b'')
+        return [value[i:i + 32] for i in range(0, len(value), 32)]
+
+    def append_hash(self, key, value):
+        """Append a 32 byte hash to the value of a key
+        """
+        self[key] = self.get(key, b'') + value
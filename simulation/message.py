@@ -17,7 +17,7 @@ from ethereum.block import (
 
 from sharding.collation import (
     Collation,
-    CollationHeader,
+    packed_header,
 )
 
 
@@ -125,7 +125,7 @@ class GetCollationHeadersResponse(rlp.Serializable):
     """ Returns a list of BlockHeaders
     """
     fields = [
-        ('collation_headers', CountableList(CollationHeader)),
+        ('collation_headers', CountableList(packed_header)),
     ]
 
     def __init__(self, collation_headers):
@@ -6,6 +6,12 @@ class Config(object):
 
     # Acceleration Parameters
     MINIMIZE_CHECKING = True
+    SIG_CACHE_SIZE = 4096           # Verified collation signatures cached per validator
+    SIG_VERIFIER_PROCESSES = 0      # Worker processes shared by the signature verifiers, 0 for none
+    SCORE_REPAIR_BUDGET = 100       # Headers read per tick to store missing collation scores
+    DB_DIR = None                   # Directory of the validators' SQLite dbs, None to keep them in memory
+    DROP_UNWATCHED_SHARDS = False   # Drop the data of a shard when the validator stops watching it
+    REORG_THREADS = 0               # Worker threads shared by the shard reorganizations, 0 for none
 
     # System Parameters
     VALIDATOR_COUNT = 10            # Main chain PoW nodes
@@ -1,3 +1,5 @@
+import itertools
+import os
 import time
 import numpy as np
 import random
@@ -10,6 +12,7 @@ from ethereum.slogging import configure_logging
 
 from sharding_utils import make_sharding_genesis
 from sharding.config import sharding_config
+from sharding.db import SQLiteDB
 
 from validator import Validator
 import validator
@@ -24,6 +27,33 @@ configure_logging(config_string=config_string)
 TIME_TX_TO_SHARD = 1000
 
 
+def mk_env(index):
+    """Environment of a validator, with a SQLite db under `p.DB_DIR` if set
+    """
+    if p.DB_DIR is None:
+        return Env(config=sharding_config)
+    if not os.path.isdir(p.DB_DIR):
+        os.makedirs(p.DB_DIR)
+    return Env(db=SQLiteDB(os.path.join(p.DB_DIR, 'validator_{}.db'.format(index))), config=sharding_config)
+
+
+def mk_shard_db_factory(index):
+    """Factory of the shard dbs of a validator, one SQLite db per shard
+    chain under `p.DB_DIR` if set, see `MainChain.mk_shard_env`
+
+    A shard rebuilt from a peer gets a new file, next to the one of the
+    shard it replaces.
+    """
+    if p.DB_DIR is None:
+        return None
+    counter = itertools.count()
+
+    def shard_db_factory(shard_id):
+        return SQLiteDB(os.path.join(
+            p.DB_DIR, 'validator_{}_shard_{}_{}.db'.format(index, shard_id, next(counter))))
+    return shard_db_factory
+
+
 # if __name__ == "__main__":
 def test_simulation():
     # Initialize NetworkSimulator
@@ -44,7 +74,7 @@ def test_simulation():
         timestamp=2)
     g = s.to_snapshot()
     print('Genesis state created')
-    validators = [Validator(g, k, n, env=Env(config=sharding_config), time_offset=p.TIME_OFFSET, validator_data=validator_data[k]) for k in keys]
+    validators = [Validator(g, k, n, env=mk_env(i), time_offset=p.TIME_OFFSET, validator_data=validator_data[k], shard_db_factory=mk_shard_db_factory(i)) for i, k in enumerate(keys)]
 
     # 2. Set NetworkSimulator n
     n.agents = validators
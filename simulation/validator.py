@@ -3,6 +3,8 @@ import random
 from collections import defaultdict
 import copy
 import functools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import rlp
 
 from ethereum import utils
@@ -20,7 +22,6 @@ from ethereum.transactions import Transaction
 from ethereum.common import mk_block_from_prevstate
 from ethereum.consensus_strategy import get_consensus_strategy
 from ethereum.genesis_helpers import mk_basic_state
-from ethereum.config import Env
 from ethereum.exceptions import VerificationFailed
 from ethereum.state import State
 
@@ -44,12 +45,16 @@ from sharding.main_chain import MainChain as Chain
 from sharding.collator import (
     create_collation,
     verify_collation_header,
+    get_collator_signer,
+    get_collator_sig,
     mk_fast_sync_state,
     verify_fast_sync_data,
     get_deep_collation_hash,
 )
 from sharding.collation import CollationHeader
 from sharding.shard_chain import ShardChain
+from sharding.db import drop_db
+from sharding.sig_verifier import SignatureVerifier
 from sharding.receipt_consuming_tx_utils import apply_shard_transaction
 from sharding.tests.test_receipt_consuming_tx_utils import mk_testing_receipt_consuming_tx
 from sharding.used_receipt_store_utils import mk_initiating_txs_for_urs
@@ -95,6 +100,27 @@ deposit_topic = utils.big_endian_to_int(utils.sha3("deposit()"))
 global_tx_to_collation = {}
 global_peer_list = defaultdict(lambda: defaultdict(list))
 
+# Worker processes shared by the signature verifiers of all validators
+sig_verifier_pool = None
+
+
+def get_sig_verifier_pool():
+    global sig_verifier_pool
+    if sig_verifier_pool is None and p.SIG_VERIFIER_PROCESSES > 0:
+        sig_verifier_pool = multiprocessing.Pool(p.SIG_VERIFIER_PROCESSES)
+    return sig_verifier_pool
+
+
+# Worker threads shared by the shard reorganizations of all validators
+reorg_pool = None
+
+
+def get_reorg_pool():
+    global reorg_pool
+    if reorg_pool is None and p.REORG_THREADS > 0:
+        reorg_pool = ThreadPool(p.REORG_THREADS)
+    return reorg_pool
+
 # Initialize accounts
 accounts = []
 keys = []
@@ -147,9 +173,9 @@ def format_receiving(f):
 
 
 class Validator(object):
-    def __init__(self, genesis, key, network, env, time_offset=5, validator_data=None):
+    def __init__(self, genesis, key, network, env, time_offset=5, validator_data=None, shard_db_factory=None):
         # Create a chain object
-        self.chain = Chain(genesis=genesis, env=env)
+        self.chain = Chain(genesis=genesis, env=env, reorg_pool=get_reorg_pool(), shard_db_factory=shard_db_factory)
         # Create a transaction queue
         self.txqueue = TransactionQueue()
         # Use the validator's time as the chain's time
@@ -210,6 +236,8 @@ class Validator(object):
         self.tx_to_shard_logs = []
         # deposit logs
         self.deposit_logs = []
+        # Collation signatures verified by this validator
+        self.sig_verifier = SignatureVerifier(cache_size=p.SIG_CACHE_SIZE, pool=get_sig_verifier_pool())
 
         self.output_buf = ''
 
@@ -295,18 +323,28 @@ class Validator(object):
         #     for x in self.chain.get_chain():
         #         assert x.hash in self.received_objects
 
+    def set_block_log_listeners(self):
+        """ Set filter add_header logs
+        """
+        if len(self.chain.state.log_listeners) == 0:
+            self.chain.append_log_listener()
+            self.chain.state.log_listeners.append(self.tx_to_shard_log_listener)
+            self.chain.state.log_listeners.append(self.deposit_log_listener)
+
     @format_receiving
     def on_receive_block(self, obj, network_id, sender_id):
         if not p.MINIMIZE_CHECKING:
             assert obj.hash not in self.chain.get_chain()
 
-        # Set filter add_header logs
-        if len(self.chain.state.log_listeners) == 0:
-            self.chain.append_log_listener()
-            self.chain.state.log_listeners.append(self.tx_to_shard_log_listener)
-            self.chain.state.log_listeners.append(self.deposit_log_listener)
+        self.set_block_log_listeners()
 
         block_success, missing_collations = self.chain.add_block(obj)
+        self.handle_added_block(obj, block_success, missing_collations, network_id, sender_id)
+
+    def handle_added_block(self, obj, block_success, missing_collations, network_id, sender_id):
+        """ Handle a block received from a peer after passing it to
+        MainChain.add_block
+        """
         self.print_info('block_success: {}'.format(block_success))
 
         # missing_collations of the late arrived block and its children
@@ -428,7 +466,14 @@ class Validator(object):
 
     @format_receiving
     def on_receive_get_blocks_response(self, obj, network_id, sender_id):
-        for block in obj.blocks:
+        self.set_block_log_listeners()
+
+        def callback(block, block_success, missing_collations):
+            self.handle_added_block(block, block_success, missing_collations, network_id, sender_id)
+        count, _ = self.chain.import_blocks(obj.blocks, callback=callback)
+        # The blocks after a gap in the run, or after a block that isn't
+        # added, are received one by one
+        for block in obj.blocks[count:]:
             self.on_receive_block(block, network_id, sender_id)
 
     @format_receiving
@@ -452,9 +497,24 @@ class Validator(object):
     def on_receive_get_collation_headers_response(self, obj, network_id, sender_id):
         if len(obj.collation_headers) > 0:
             req_headers = []
+            # Check the signatures of the batch up front against the sampled
+            # collators, in the worker processes if there are any;
+            # verify_collation_header then hits the cache, and skips the
+            # contract call for the headers already verified on the current
+            # head
+            temp_state = prepare_next_state(self.chain)
+            signers = {}
+            for header in obj.collation_headers:
+                if header.shard_id not in signers:
+                    signers[header.shard_id] = get_collator_signer(temp_state, header.shard_id)
+            self.sig_verifier.verify_many(
+                (header.signing_hash, get_collator_sig(header), signers[header.shard_id])
+                for header in obj.collation_headers
+                if signers[header.shard_id] is not None
+            )
             for header in obj.collation_headers:
                 try:
-                    verify_collation_header(self.chain, header)
+                    verify_collation_header(self.chain, header, sig_verifier=self.sig_verifier)
                     req_headers.append(header)
                 except ValueError as e:
                     self.print_info(str(e))
@@ -509,7 +569,6 @@ class Validator(object):
         if shard_id not in self.shard_id_list:
             return
 
-        shard = ShardChain(shard_id, env=Env(config=self.chain.env.config))
         if obj.collations is None:
             self.print_info('Can\'t get collations from peer')
             return
@@ -523,14 +582,29 @@ class Validator(object):
             self.chain.shards[shard_id].is_syncing = False
             return
 
-        for c in obj.collations:
-            period_start_prevblock = self.chain.get_block(c.period_start_prevhash)
-            shard.add_collation(c, period_start_prevblock)
+        # Rebuild the shard from the collations of the peer in a new db, and
+        # replace the current one only once they are imported
+        shard = ShardChain(
+            shard_id,
+            initial_state=generate_testing_shard(self.chain, shard_id, keys[0]),
+            main_chain=self.chain)
+        try:
+            with shard.write_batch():
+                for c in obj.collations:
+                    period_start_prevblock = self.chain.get_block(c.period_start_prevhash)
+                    shard.add_collation(c, period_start_prevblock)
+        except Exception as e:
+            self.print_info('Failed to update shard {} from peer: {}'.format(shard_id, str(e)))
+            drop_db(shard.db)
+            if self.chain.has_shard(shard_id):
+                self.chain.shards[shard_id].is_syncing = False
+            return
 
         if obj.collations:
             shard.head_hash = obj.collations[-1].hash
         self.print_info('Updated shard {} from peer'.format(shard_id))
-        self.chain.shards[shard_id] = shard
+        self.chain.drop_shard(shard_id)
+        self.chain.add_shard(shard)
         self.chain.shards[shard_id].is_syncing = False
 
     @format_receiving
@@ -575,11 +649,11 @@ class Validator(object):
             return
 
         state_data = json.loads(rlp.decode(obj.state_data))
-        # NOTE: In reality, the self.chain.env could be replaced by new env with new db
-        state = State.from_snapshot(state_data, self.chain.env, executing_on_head=True)
 
         if not self.chain.has_shard(shard_id):
             self.new_shard(shard_id)
+        # The state is written to the db of the shard
+        state = State.from_snapshot(state_data, self.chain.shards[shard_id].env, executing_on_head=True)
 
         if self.chain.shards[shard_id].head.number < obj.collation.number:
             try:
@@ -626,6 +700,8 @@ class Validator(object):
             #     self.tick_tx(shard_id)
             if self.network.time % 100 == 0:
                 self.clear_txqueue(shard_id)
+            if self.chain.has_shard(shard_id):
+                self.chain.shards[shard_id].repair_score_index(p.SCORE_REPAIR_BUDGET)
 
     def tick_cycle(self):
         if not self.is_SERENITY():
@@ -703,11 +779,7 @@ class Validator(object):
 
         blk = self.mining_block
 
-        # Set filter add_header logs
-        if len(self.chain.state.log_listeners) == 0:
-            self.chain.append_log_listener()
-            self.chain.state.log_listeners.append(self.tx_to_shard_log_listener)
-            self.chain.state.log_listeners.append(self.deposit_log_listener)
+        self.set_block_log_listeners()
 
         success, _ = self.chain.add_block(blk)
         if not p.MINIMIZE_CHECKING:
@@ -1038,7 +1110,10 @@ class Validator(object):
         activate_set = new_shard_id_list - self.shard_id_list
 
         for shard_id in deactivate_set:
-            self.chain.shards[shard_id].deactivate()
+            if p.DROP_UNWATCHED_SHARDS:
+                self.chain.drop_shard(shard_id)
+            else:
+                self.chain.shards[shard_id].deactivate()
         for shard_id in activate_set:
             if not self.chain.has_shard(shard_id):
                 self.new_shard(shard_id)
@@ -1092,9 +1167,8 @@ class Validator(object):
             self.print_info('collation_map: {}'.format(collation_map))
 
         self.print_info('Reorganizing......')
+        self.chain.reorganize_shards(block, collation_map)
         for shard_id in self.shard_id_list:
-            collation = collation_map[shard_id] if shard_id in collation_map else None
-            self.chain.reorganize_head_collation(block, collation)
             self.update_shard_head(shard_id)
             if shard_id in missing_collations_map:
                 # for collation_hash in missing_collations_map[shard_id]:
@@ -1196,14 +1270,15 @@ class Validator(object):
     def get_collation_headers(self, shard_id, collation, amount):
         """ Get CollationHeaders  around `collation`
         """
-        counter = self.chain.shards[shard_id].head.number
+        shard = self.chain.shards[shard_id]
+        counter = shard.get_collation_header(shard.head_hash).number
         limit = (collation.number - amount + 1) if (collation.number - amount + 1) > 0 else 0
         headers = []
+        header = collation.header
         while counter >= limit:
-            headers.append(collation.header)
-            collhash = collation.parent_collation_hash
-            collation = self.chain.shards[shard_id].get_collation(collhash)
-            if collation is None:
+            headers.append(header)
+            header = shard.get_collation_header(header.parent_collation_hash)
+            if header is None:
                 break
             counter -= 1
         return headers[::-1]
@@ -1278,7 +1353,7 @@ class Validator(object):
 def generate_testing_shard(chain, shard_id, sender_privkey):
     """ Generate initial state of shards
     """
-    shard_state = mk_basic_state(base_alloc, None, chain.env)
+    shard_state = mk_basic_state(base_alloc, None, chain.mk_shard_env(shard_id))
     shard_state.gas_limit = 4712388  # 10**8 * (p.VALIDATOR_COUNT + 1)
     txs = mk_initiating_txs_for_urs(
         sender_privkey,